@@ -1,8 +1,74 @@
 import json
 import os
 import hashlib
+import hmac
 from datetime import datetime
+import psycopg2
+from compression import with_compression
+from profiling import with_profiling
+from rates import create_rate_cache
+from qr import build_payment_uri, render_qr_data_uri, format_amount
+from intents import (reserve_payment_intent, load_transfers, reconcile_transfers, AmountUnavailableError,
+                     PAYMENT_INTENT_TTL)
 
+# Курсы живут в памяти тёплого контейнера и обновляются в фоне
+rate_cache = create_rate_cache()
+
+# Секрет, который вызывающий сверку сервис передаёт в заголовке X-Reconcile-Token
+RECONCILE_TOKEN = os.environ.get('RECONCILE_TOKEN', '')
+
+def get_header(event: dict, name: str) -> str:
+    '''Возвращает значение заголовка запроса без учёта регистра имени'''
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name.lower():
+            return value
+    return ''
+
+def handle_reconcile(event: dict, data: dict) -> dict:
+    '''Сверка пакета наблюдаемых переводов с ожидающими платёжными намерениями'''
+    token = get_header(event, 'X-Reconcile-Token')
+    if not RECONCILE_TOKEN or not hmac.compare_digest(token.encode('utf-8'), RECONCILE_TOKEN.encode('utf-8')):
+        return {
+            'statusCode': 403,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': json.dumps({'error': 'Доступ запрещён'})
+        }
+    
+    transfers = load_transfers(data)
+    
+    for index, transfer in enumerate(transfers):
+        if not all([transfer.get('txHash'), transfer.get('currency'), transfer.get('amount')]):
+            return {
+                'statusCode': 400,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps({'error': f'Перевод #{index}: не указаны обязательные поля: txHash, currency, amount'})
+            }
+    
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        result = reconcile_transfers(cur, conn, transfers)
+        cur.close()
+    finally:
+        conn.close()
+    
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps({'success': True, **result})
+    }
+
+@with_profiling
+@with_compression
 def handler(event: dict, context) -> dict:
     '''Генерация криптовалютного адреса и QR-кода для пополнения баланса'''
     
@@ -31,6 +97,10 @@ def handler(event: dict, context) -> dict:
     
     try:
         data = json.loads(event.get('body', '{}'))
+        
+        if data.get('action') == 'reconcile':
+            return handle_reconcile(event, data)
+        
         user_id = data.get('userId')
         amount = data.get('amount')
         currency = data.get('currency', 'USDT')  # USDT, BTC, ETH
@@ -67,18 +137,35 @@ def handler(event: dict, context) -> dict:
         # Генерируем ID транзакции
         transaction_id = hashlib.sha256(f"{user_id}-{amount}-{currency}-{datetime.now().isoformat()}".encode()).hexdigest()[:16]
         
-        # Курсы криптовалют к рублю (заглушка - в реальности нужно получать через API)
-        exchange_rates = {
-            'USDT': float(os.environ.get('USDT_TO_RUB_RATE', '92')),
-            'BTC': float(os.environ.get('BTC_TO_RUB_RATE', '8500000')),
-            'ETH': float(os.environ.get('ETH_TO_RUB_RATE', '320000'))
-        }
+        # Курсы криптовалют к рублю из кэша (источник задаётся EXCHANGE_RATE_SOURCE)
+        exchange_rates, rate_age = rate_cache.get()
+        exchange_rate = exchange_rates[currency]
+        
+        # Сохраняем ожидаемый платёж с уникальной суммой для последующей сверки с переводами в сети
+        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        try:
+            cur = conn.cursor()
+            try:
+                amount_crypto, expires_at = reserve_payment_intent(cur, conn, transaction_id, user_id, currency,
+                                                                   wallet_address, amount, exchange_rate)
+            except AmountUnavailableError as e:
+                return {
+                    'statusCode': 409,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*'
+                    },
+                    'body': json.dumps({'error': str(e)})
+                }
+            cur.close()
+        finally:
+            conn.close()
         
-        crypto_amount = round(amount / exchange_rates[currency], 8)
+        crypto_amount = float(amount_crypto)
         
-        # URL для QR кода
-        qr_data = f"{wallet_address}"
-        qr_code_url = f"https://api.qrserver.com/v1/create-qr-code/?size=300x300&data={qr_data}"
+        # QR код с платёжной ссылкой (адрес и точная сумма) рендерится локально и кэшируется
+        payment_uri = build_payment_uri(currency, wallet_address, amount_crypto)
+        qr_code_url = render_qr_data_uri(payment_uri)
         
         return {
             'statusCode': 200,
@@ -93,9 +180,13 @@ def handler(event: dict, context) -> dict:
                 'walletAddress': wallet_address,
                 'amountRub': amount,
                 'amountCrypto': crypto_amount,
-                'exchangeRate': exchange_rates[currency],
+                'exchangeRate': exchange_rate,
+                'rateAge': round(rate_age, 1),
+                'rateSource': rate_cache.source.name,
+                'paymentUri': payment_uri,
+                'expiresAt': expires_at.isoformat(),
                 'qrCodeUrl': qr_code_url,
-                'instructions': f'Переведите {crypto_amount} {currency} на адрес {wallet_address}. После подтверждения транзакции баланс будет пополнен автоматически.',
+                'instructions': f'Переведите ровно {format_amount(amount_crypto)} {currency} на адрес {wallet_address} в течение {PAYMENT_INTENT_TTL} минут. После подтверждения транзакции баланс будет пополнен автоматически.',
                 'network': 'TRC20' if currency == 'USDT' else currency,
                 'date': datetime.now().isoformat()
             })
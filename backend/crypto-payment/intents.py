@@ -0,0 +1,188 @@
+'''
+Платёжные намерения и сверка входящих переводов.
+Намерение сохраняется при выдаче реквизитов с уникальной среди ожидающих суммой
+(к базовой сумме добавляется несколько единиц последнего знака) и истекает через
+PAYMENT_INTENT_TTL минут. Сумма истёкшего намерения ещё PAYMENT_AMOUNT_QUARANTINE минут
+не выдаётся другим, а опоздавший перевод по ней зачисляется владельцу. Сверка сопоставляет пакет наблюдаемых в сети переводов
+с ожидающими намерениями по (валюта, сумма) за один проход и зачисляет найденные
+платежи через timer-manager одним запросом.
+'''
+import json
+import os
+import urllib.request
+from decimal import Decimal, ROUND_HALF_UP
+from psycopg2.extras import execute_values
+
+TIMER_MANAGER_URL = os.environ.get('TIMER_MANAGER_URL', 'https://functions.poehali.dev/a23898cb-270c-4d21-8199-e4efe343c233')
+INTERNAL_API_TOKEN = os.environ.get('INTERNAL_API_TOKEN', '')
+CRYPTO_AMOUNT_STEP = Decimal('0.00000001')
+
+# Точность суммы в кошельках: USDT (TRC20) - 6 знаков, BTC - сатоши, ETH - 8 знаков в ссылке
+CRYPTO_DECIMALS = {'USDT': 6, 'BTC': 8, 'ETH': 8}
+
+PAYMENT_INTENT_TTL = int(os.environ.get('PAYMENT_INTENT_TTL', '60'))
+# Надбавка для уникальности суммы не больше этой суммы в рублях
+PAYMENT_AMOUNT_MAX_OFFSET_RUB = Decimal(os.environ.get('PAYMENT_AMOUNT_MAX_OFFSET_RUB', '10'))
+PAYMENT_AMOUNT_MAX_STEPS = 10000
+# Карантин суммы после истечения намерения: должен быть заметно больше интервала запуска сверки
+PAYMENT_AMOUNT_QUARANTINE = int(os.environ.get('PAYMENT_AMOUNT_QUARANTINE', '1440'))
+PAYMENT_INTENT_INSERT_ATTEMPTS = 5
+
+class AmountUnavailableError(Exception):
+    '''Все уникальные суммы в допустимом диапазоне надбавки заняты ожидающими намерениями'''
+
+def crypto_amount_key(currency: str, amount) -> tuple:
+    '''Ключ сопоставления: валюта и сумма с точностью до 8 знаков, как в payment_intents'''
+    return currency, Decimal(str(amount)).quantize(CRYPTO_AMOUNT_STEP)
+
+def expire_payment_intents(cur):
+    '''Переводит просроченные ожидающие намерения в expired, их суммы уходят в карантин'''
+    cur.execute('''
+        UPDATE payment_intents SET status = 'expired'
+        WHERE status = 'pending' AND expires_at < CURRENT_TIMESTAMP
+    ''')
+    if cur.rowcount:
+        print(f'[INTENTS] Expired {cur.rowcount} pending intents')
+
+def reserve_payment_intent(cur, conn, transaction_id: str, user_id, currency: str, wallet_address: str,
+                           amount_rub, exchange_rate) -> tuple:
+    '''Сохраняет ожидаемый платёж с уникальной суммой, возвращает (сумма в криптовалюте, срок действия)'''
+    step = Decimal(1).scaleb(-CRYPTO_DECIMALS[currency])
+    base = (Decimal(str(amount_rub)) / Decimal(str(exchange_rate))).quantize(step, rounding=ROUND_HALF_UP)
+    max_steps = min(PAYMENT_AMOUNT_MAX_STEPS,
+                    max(1, int(PAYMENT_AMOUNT_MAX_OFFSET_RUB / Decimal(str(exchange_rate)) / step)))
+
+    for _ in range(PAYMENT_INTENT_INSERT_ATTEMPTS):
+        expire_payment_intents(cur)
+        # Сумма недавно истёкшего намерения занята: его перевод может прийти позже срока
+        cur.execute('''
+            SELECT amount_crypto FROM payment_intents
+            WHERE currency = %s AND amount_crypto BETWEEN %s AND %s
+              AND (status = 'pending'
+                   OR (status = 'expired' AND expires_at > CURRENT_TIMESTAMP - make_interval(mins => %s)))
+        ''', (currency, base, base + step * max_steps, PAYMENT_AMOUNT_QUARANTINE))
+        taken = {row[0] for row in cur.fetchall()}
+        amount_crypto = next((base + step * offset for offset in range(max_steps + 1)
+                              if base + step * offset not in taken), None)
+        if amount_crypto is None:
+            conn.rollback()
+            raise AmountUnavailableError(f'Нет свободной суммы {currency} около {base}, повторите позже')
+
+        # Параллельный запрос мог занять ту же сумму: уникальный индекс отклонит вставку, пробуем снова
+        cur.execute('''
+            INSERT INTO payment_intents
+                (transaction_id, user_id, currency, wallet_address, amount_rub, amount_crypto,
+                 exchange_rate, expires_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP + make_interval(mins => %s))
+            ON CONFLICT (currency, amount_crypto) WHERE status = 'pending' DO NOTHING
+            RETURNING expires_at
+        ''', (transaction_id, int(user_id), currency, wallet_address, amount_rub,
+              amount_crypto, exchange_rate, PAYMENT_INTENT_TTL))
+        row = cur.fetchone()
+        conn.commit()
+        if row:
+            return amount_crypto, row[0]
+
+    raise AmountUnavailableError(f'Не удалось зарезервировать сумму {currency}, повторите позже')
+
+def load_transfers(data: dict) -> list:
+    '''Переводы из тела запроса или из локального файла RECONCILE_FIXTURE_PATH'''
+    if data.get('transfers') is not None:
+        return data['transfers']
+    fixture_path = os.environ.get('RECONCILE_FIXTURE_PATH')
+    if not fixture_path:
+        return []
+    with open(fixture_path, encoding='utf-8') as f:
+        return json.load(f)
+
+def credit_balances(items: list) -> list:
+    '''Зачисляет пополнения через add_balance_bulk в timer-manager.
+    Пополнения идемпотентны по reference, поэтому повтор после таймаута не зачисляет дважды.'''
+    request = urllib.request.Request(
+        TIMER_MANAGER_URL,
+        data=json.dumps({'action': 'add_balance_bulk', 'items': items}).encode('utf-8'),
+        headers={'Content-Type': 'application/json', 'X-Internal-Token': INTERNAL_API_TOKEN},
+        method='POST'
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())
+
+def reconcile_transfers(cur, conn, transfers: list) -> dict:
+    '''Сопоставляет переводы {txHash, currency, amount, address} с ожидающими намерениями и зачисляет их.
+    Намерения, истёкшие в пределах карантина, тоже участвуют: их суммы никому не выдавались повторно.
+    Переводы, опоздавшие больше чем на карантин, попадают в unmatched и разбираются вручную.'''
+    expire_payment_intents(cur)
+
+    tx_hashes = [t['txHash'] for t in transfers]
+    cur.execute('''
+        SELECT tx_hash FROM payment_intents WHERE tx_hash = ANY(%s)
+    ''', (tx_hashes,))
+    seen = {row[0] for row in cur.fetchall()}
+
+    keys = {crypto_amount_key(t['currency'], t['amount']) for t in transfers}
+    pending = {}
+    if keys:
+        currencies, amounts = zip(*keys)
+        cur.execute('''
+            SELECT pi.transaction_id, pi.user_id, pi.currency, pi.amount_crypto, pi.amount_rub, pi.wallet_address
+            FROM payment_intents pi
+            JOIN unnest(%s::varchar[], %s::numeric[]) AS t(currency, amount_crypto)
+                ON pi.currency = t.currency AND pi.amount_crypto = t.amount_crypto
+            WHERE pi.status = 'pending'
+               OR (pi.status = 'expired' AND pi.expires_at > CURRENT_TIMESTAMP - make_interval(mins => %s))
+            FOR UPDATE OF pi
+        ''', (list(currencies), list(amounts), PAYMENT_AMOUNT_QUARANTINE))
+        for intent in cur.fetchall():
+            pending.setdefault((intent[2], intent[3]), []).append(intent)
+
+    matched, unmatched, ambiguous, duplicates = [], [], [], []
+    for transfer in transfers:
+        tx_hash = transfer['txHash']
+        if tx_hash in seen:
+            duplicates.append(tx_hash)
+            continue
+        seen.add(tx_hash)
+
+        key = crypto_amount_key(transfer['currency'], transfer['amount'])
+        candidates = pending.get(key)
+        if not candidates:
+            unmatched.append(tx_hash)
+        elif len(candidates) > 1:
+            # Несколько пользователей ждут одинаковую сумму: автоматически не зачисляем
+            ambiguous.append(tx_hash)
+        elif transfer.get('address') and transfer['address'] != candidates[0][5]:
+            unmatched.append(tx_hash)
+        else:
+            matched.append((candidates.pop(), tx_hash))
+
+    if matched:
+        execute_values(cur, '''
+            UPDATE payment_intents pi
+            SET status = 'matched', tx_hash = m.tx_hash, matched_at = CURRENT_TIMESTAMP
+            FROM (VALUES %s) AS m(transaction_id, tx_hash)
+            WHERE pi.transaction_id = m.transaction_id
+        ''', [(intent[0], tx_hash) for intent, tx_hash in matched])
+
+        try:
+            credit_balances([
+                {'user_id': intent[1], 'amount': float(intent[4]), 'admin_name': f'crypto:{tx_hash}',
+                 'reference': f'crypto:{tx_hash}'}
+                for intent, tx_hash in matched
+            ])
+        except Exception:
+            conn.rollback()
+            raise
+    conn.commit()
+
+    print(f'[RECONCILE] {len(transfers)} transfers: matched={len(matched)}, unmatched={len(unmatched)}, '
+          f'ambiguous={len(ambiguous)}, duplicates={len(duplicates)}')
+
+    return {
+        'matched': [
+            {'transactionId': intent[0], 'userId': intent[1], 'txHash': tx_hash, 'amountRub': float(intent[4])}
+            for intent, tx_hash in matched
+        ],
+        'unmatched': unmatched,
+        'ambiguous': ambiguous,
+        'duplicates': duplicates
+    }
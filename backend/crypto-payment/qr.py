@@ -0,0 +1,36 @@
+'''
+QR-коды для оплаты: платёжная ссылка в формате кошельков (BIP21, EIP-681, TRON)
+и SVG-картинка в data URI, которая рендерится внутри функции и кэшируется в LRU по ссылке.
+'''
+import os
+from decimal import Decimal
+from functools import lru_cache
+import segno
+
+QR_CACHE_SIZE = int(os.environ.get('QR_CACHE_SIZE', '512'))
+QR_SIZE_PX = 300
+
+# Контракт токена USDT в сети TRON (TRC20)
+USDT_TRC20_CONTRACT = 'TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t'
+
+def format_amount(amount) -> str:
+    '''Сумма без экспоненциальной записи и лишних нулей'''
+    return format(Decimal(str(amount)).normalize(), 'f')
+
+def build_payment_uri(currency: str, address: str, amount) -> str:
+    '''Платёжная ссылка с адресом и суммой, которую кошелёк подставит сам'''
+    if currency == 'BTC':
+        return f'bitcoin:{address}?amount={format_amount(amount)}'
+    if currency == 'ETH':
+        wei = int(Decimal(str(amount)) * 10 ** 18)
+        return f'ethereum:{address}@1?value={wei}'
+    if currency == 'USDT':
+        return f'tron:{address}?token={USDT_TRC20_CONTRACT}&amount={format_amount(amount)}'
+    raise ValueError(f'Неподдерживаемая криптовалюта: {currency}')
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def render_qr_data_uri(payment_uri: str) -> str:
+    '''SVG QR-кода размером около QR_SIZE_PX пикселей в виде data URI'''
+    qr = segno.make(payment_uri, error='m')
+    width, _ = qr.symbol_size(scale=1)
+    return qr.svg_data_uri(scale=max(1, QR_SIZE_PX // width))
@@ -0,0 +1,134 @@
+'''
+Курсы криптовалют к рублю: подключаемые источники и кэш в памяти контейнера.
+Свежие курсы (моложе TTL) отдаются из кэша, устаревшие в пределах MAX_AGE отдаются сразу
+и обновляются в фоне (stale-while-revalidate), а при отсутствии курсов запрос ждёт загрузки.
+Одновременные промахи объединяются в одну загрузку.
+'''
+import json
+import os
+import threading
+import time
+import urllib.request
+
+RATE_TTL = float(os.environ.get('EXCHANGE_RATE_TTL', '60'))
+RATE_MAX_AGE = float(os.environ.get('EXCHANGE_RATE_MAX_AGE', '600'))
+
+class EnvRateSource:
+    '''Фиксированные курсы из переменных окружения'''
+    name = 'env'
+
+    def fetch(self) -> dict:
+        return {
+            'USDT': float(os.environ.get('USDT_TO_RUB_RATE', '92')),
+            'BTC': float(os.environ.get('BTC_TO_RUB_RATE', '8500000')),
+            'ETH': float(os.environ.get('ETH_TO_RUB_RATE', '320000'))
+        }
+
+class CoinGeckoRateSource:
+    '''Курсы с публичного API CoinGecko'''
+    name = 'coingecko'
+    coin_ids = {'USDT': 'tether', 'BTC': 'bitcoin', 'ETH': 'ethereum'}
+
+    def __init__(self, timeout: float = 3.0):
+        self.url = os.environ.get('EXCHANGE_RATE_API_URL', 'https://api.coingecko.com/api/v3/simple/price')
+        self.timeout = timeout
+
+    def fetch(self) -> dict:
+        url = f"{self.url}?ids={','.join(self.coin_ids.values())}&vs_currencies=rub"
+        with urllib.request.urlopen(url, timeout=self.timeout) as response:
+            prices = json.loads(response.read())
+        return {currency: float(prices[coin_id]['rub']) for currency, coin_id in self.coin_ids.items()}
+
+class FakeRateSource:
+    '''Локальный источник для тестов: заданные курсы, искусственная задержка и счётчик загрузок'''
+    name = 'fake'
+
+    def __init__(self, rates: dict = None, delay: float = 0.0):
+        self.rates = rates or {'USDT': 90.0, 'BTC': 8000000.0, 'ETH': 300000.0}
+        self.delay = delay
+        self.calls = 0
+
+    def fetch(self) -> dict:
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        return dict(self.rates)
+
+RATE_SOURCES = {
+    'env': EnvRateSource,
+    'coingecko': CoinGeckoRateSource,
+    'fake': FakeRateSource
+}
+
+class RateCache:
+    '''Кэш курсов с TTL, границей устаревания и объединением одновременных загрузок'''
+
+    def __init__(self, source, ttl: float = RATE_TTL, max_age: float = RATE_MAX_AGE, clock=time.monotonic):
+        self.source = source
+        self.ttl = ttl
+        self.max_age = max_age
+        self.clock = clock
+        self._rates = None
+        self._fetched_at = None
+        self._error = None
+        self._refresh_done = None
+        self._lock = threading.Lock()
+
+    def get(self) -> tuple:
+        '''Возвращает (курсы, возраст курсов в секундах)'''
+        with self._lock:
+            age = self._age()
+            if age is not None and age < self.ttl:
+                return self._rates, age
+            if age is not None and age < self.max_age:
+                done, owner = self._begin_refresh()
+                if owner:
+                    threading.Thread(target=self._refresh, args=(done,), daemon=True).start()
+                return self._rates, age
+            done, owner = self._begin_refresh()
+
+        if owner:
+            self._refresh(done)
+        else:
+            done.wait()
+
+        with self._lock:
+            age = self._age()
+            if age is None or age >= self.max_age:
+                raise RuntimeError(f'Курсы валют недоступны ({self.source.name}): {self._error}')
+            return self._rates, age
+
+    def _age(self):
+        if self._fetched_at is None:
+            return None
+        return self.clock() - self._fetched_at
+
+    def _begin_refresh(self) -> tuple:
+        '''Возвращает (событие завершения загрузки, запускает ли её вызывающий). Вызывается под блокировкой'''
+        if self._refresh_done is not None:
+            return self._refresh_done, False
+        self._refresh_done = threading.Event()
+        return self._refresh_done, True
+
+    def _refresh(self, done: threading.Event):
+        rates, error = None, None
+        try:
+            rates = self.source.fetch()
+        except Exception as e:
+            error = e
+            print(f'[RATES] Refresh from {self.source.name} failed: {type(e).__name__}: {e}')
+
+        with self._lock:
+            if rates is not None:
+                self._rates = rates
+                self._fetched_at = self.clock()
+            self._error = error
+            self._refresh_done = None
+        done.set()
+
+def create_rate_cache() -> RateCache:
+    '''Кэш курсов для источника из EXCHANGE_RATE_SOURCE (env, coingecko, fake)'''
+    source_name = os.environ.get('EXCHANGE_RATE_SOURCE', 'env')
+    if source_name not in RATE_SOURCES:
+        raise ValueError(f'Неизвестный источник курсов: {source_name}')
+    return RateCache(RATE_SOURCES[source_name]())
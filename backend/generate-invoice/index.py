@@ -1,76 +1,108 @@
 import json
 import os
+import hashlib
+import hmac
+import html
+import secrets
+import tempfile
+import io
+import uuid
+import zipfile
+import threading
 from datetime import datetime
+import boto3
+import psycopg2
+from psycopg2.extras import execute_values
+from compression import with_compression
+from profiling import with_profiling
 
-def handler(event: dict, context) -> dict:
-    '''Генерация счёта на оплату для пополнения баланса клиента'''
+# Размер блока номеров, который контейнер резервирует в БД за один запрос
+INVOICE_BLOCK_SIZE = int(os.environ.get('INVOICE_BLOCK_SIZE', '50'))
+
+# Пакетная генерация: максимальный размер пакета и размер страницы вставки в БД
+INVOICE_BATCH_MAX_SIZE = int(os.environ.get('INVOICE_BATCH_MAX_SIZE', '10000'))
+INVOICE_BATCH_PAGE_SIZE = 500
+
+# Сохранённый счёт отдаётся как text/html: скрипты и внешние ресурсы, кроме картинок, запрещены
+INVOICE_CONTENT_SECURITY_POLICY = "default-src 'none'; img-src https: data:; style-src 'unsafe-inline'"
+
+# Результат пакета пишется в S3 частями multipart upload (не меньше 5 МБ), ссылка на него временная
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', 'https://bucket.poehali.dev')
+S3_BUCKET = 'files'
+INVOICE_BATCH_PART_SIZE = int(os.environ.get('INVOICE_BATCH_PART_SIZE', str(8 * 1024 * 1024)))
+INVOICE_BATCH_URL_TTL = int(os.environ.get('INVOICE_BATCH_URL_TTL', '3600'))
+
+# Сохранённый счёт неизменен, но содержит данные плательщика: кэшируется только браузером
+INVOICE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+# Локальные блоки номеров тёплого контейнера: {год: (следующий номер, последний номер блока)}
+_invoice_blocks = {}
+_invoice_blocks_lock = threading.Lock()
+
+def allocate_invoice_block(year: int, size: int) -> tuple:
+    '''Резервирует в БД блок из size номеров счетов за год, возвращает (первый, последний)'''
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute('''
+            INSERT INTO invoice_counters (year, last_value)
+            VALUES (%s, %s)
+            ON CONFLICT (year)
+            DO UPDATE SET
+                last_value = invoice_counters.last_value + EXCLUDED.last_value,
+                updated_at = CURRENT_TIMESTAMP
+            RETURNING last_value
+        ''', (year, size))
+        last_value = cur.fetchone()[0]
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
     
-    method = event.get('httpMethod', 'GET')
+    print(f'[INVOICE_BLOCK] Allocated {year}: {last_value - size + 1}..{last_value}')
+    return last_value - size + 1, last_value
+
+def next_invoice_numbers(year: int, count: int = 1) -> list:
+    '''Выдаёт count номеров счетов из локального блока, при нехватке резервирует новый блок (hi/lo)'''
+    with _invoice_blocks_lock:
+        current, last = _invoice_blocks.get(year, (1, 0))
+        numbers = list(range(current, min(last + 1, current + count)))
+        missing = count - len(numbers)
+        
+        if missing > 0:
+            first, last = allocate_invoice_block(year, max(missing, INVOICE_BLOCK_SIZE))
+            numbers.extend(range(first, first + missing))
+            current = first + missing
+        else:
+            current += count
+        
+        _invoice_blocks[year] = (current, last)
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
-            'body': ''
-        }
+    return numbers
+
+def render_invoice_html(invoice_number: str, user_id, username: str, amount, issued_at: datetime) -> str:
+    '''Формирует HTML счёта на оплату по реквизитам компании из переменных окружения'''
+    # Данные компании
+    company_name = os.environ.get('COMPANY_NAME', 'ООО "Ваша Компания"')
+    company_inn = os.environ.get('COMPANY_INN', '1234567890')
+    company_kpp = os.environ.get('COMPANY_KPP', '772801001')
+    company_account = os.environ.get('COMPANY_ACCOUNT', '40702810000000000000')
+    company_bank = os.environ.get('COMPANY_BANK', 'ПАО "Сбербанк"')
+    company_bik = os.environ.get('COMPANY_BIK', '044525225')
+    company_correspondent = os.environ.get('COMPANY_CORRESPONDENT', '30101810400000000225')
+    director_name = os.environ.get('DIRECTOR_NAME', 'Иванов И.И.')
     
-    if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Метод не поддерживается'})
-        }
+    # URL изображений печати и подписи
+    signature_url = os.environ.get('SIGNATURE_IMAGE_URL', '')
+    stamp_url = os.environ.get('STAMP_IMAGE_URL', '')
     
-    try:
-        data = json.loads(event.get('body', '{}'))
-        user_id = data.get('userId')
-        username = data.get('username')
-        amount = data.get('amount')
-        
-        if not all([user_id, username, amount]):
-            return {
-                'statusCode': 400,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({'error': 'Не указаны обязательные поля: userId, username, amount'})
-            }
-        
-        # Генерируем номер счёта в формате: текущий_год-порядковый_номер
-        current_year = datetime.now().year
-        invoice_counter_key = f'invoice_counter_{current_year}'
-        
-        # Получаем счётчик из переменной окружения (в продакшене - из БД)
-        counter = int(os.environ.get(invoice_counter_key, '0')) + 1
-        invoice_number = f"{current_year}-{counter}"
-        
-        # Сохраняем новый счётчик (в продакшене - в БД)
-        os.environ[invoice_counter_key] = str(counter)
-        
-        # Данные компании
-        company_name = os.environ.get('COMPANY_NAME', 'ООО "Ваша Компания"')
-        company_inn = os.environ.get('COMPANY_INN', '1234567890')
-        company_kpp = os.environ.get('COMPANY_KPP', '772801001')
-        company_account = os.environ.get('COMPANY_ACCOUNT', '40702810000000000000')
-        company_bank = os.environ.get('COMPANY_BANK', 'ПАО "Сбербанк"')
-        company_bik = os.environ.get('COMPANY_BIK', '044525225')
-        company_correspondent = os.environ.get('COMPANY_CORRESPONDENT', '30101810400000000225')
-        director_name = os.environ.get('DIRECTOR_NAME', 'Иванов И.И.')
-        
-        # URL изображений печати и подписи
-        signature_url = os.environ.get('SIGNATURE_IMAGE_URL', '')
-        stamp_url = os.environ.get('STAMP_IMAGE_URL', '')
-        
-        # Формируем HTML счёта
-        invoice_html = f'''
+    # Данные плательщика приходят из запроса, а HTML сохраняется и отдаётся как документ: экранируем
+    user_id = html.escape(str(user_id))
+    username = html.escape(str(username))
+    amount = html.escape(str(amount))
+    
+    # Формируем HTML счёта
+    return f'''
 <!DOCTYPE html>
 <html>
 <head>
@@ -88,7 +120,7 @@ def handler(event: dict, context) -> dict:
 <body>
     <div class="header">
         <h1>Счёт на оплату №{invoice_number}</h1>
-        <p>от {datetime.now().strftime('%d.%m.%Y')}</p>
+        <p>от {issued_at.strftime('%d.%m.%Y')}</p>
     </div>
     
     <div class="company-info">
@@ -148,7 +180,342 @@ def handler(event: dict, context) -> dict:
     </div>
 </body>
 </html>
-        '''
+    '''
+
+def get_header(event: dict, name: str) -> str:
+    '''Возвращает значение заголовка запроса без учёта регистра имени'''
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name.lower():
+            return value
+    return ''
+
+def invoice_etag(invoice_html: str) -> str:
+    '''ETag счёта - sha256 от HTML документа'''
+    return hashlib.sha256(invoice_html.encode('utf-8')).hexdigest()
+
+def save_invoices(cur, rows: list):
+    '''Сохраняет счета одним запросом: строки (номер, user_id, имя, сумма, html, etag, токен доступа)'''
+    execute_values(cur, '''
+        INSERT INTO invoices (invoice_number, user_id, username, amount, html, etag, access_token)
+        VALUES %s
+    ''', rows)
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    '''Проверяет заголовок If-None-Match (список ETag, слабые W/ и *) на совпадение с ETag счёта'''
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == '*' or candidate.strip('"') == etag:
+            return True
+    return False
+
+def get_invoice(event: dict) -> dict:
+    '''Отдаёт сохранённый счёт по номеру и токену доступа с кэшированием и поддержкой условных запросов'''
+    params = event.get('queryStringParameters') or {}
+    invoice_number = params.get('number')
+    access_token = params.get('token')
+    
+    if not invoice_number or not access_token:
+        return {
+            'statusCode': 400,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': json.dumps({'error': 'Не указаны номер счёта и токен доступа: number, token'})
+        }
+    
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT html, etag, access_token FROM invoices WHERE invoice_number = %s
+        ''', (invoice_number,))
+        invoice = cur.fetchone()
+        cur.close()
+    finally:
+        conn.close()
+    
+    # Неверный токен неотличим от отсутствующего счёта, чтобы номера нельзя было перебрать
+    if not invoice or not invoice[2] or not hmac.compare_digest(invoice[2].encode('utf-8'), access_token.encode('utf-8')):
+        return {
+            'statusCode': 404,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': json.dumps({'error': f'Счёт №{invoice_number} не найден'})
+        }
+    
+    invoice_html, etag, _ = invoice
+    headers = {
+        'ETag': f'"{etag}"',
+        'Cache-Control': INVOICE_CACHE_CONTROL,
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag'
+    }
+    
+    # Номер счёта не переиспользуется, поэтому документ неизменен и его можно кэшировать
+    if etag_matches(get_header(event, 'If-None-Match'), etag):
+        return {'statusCode': 304, 'headers': headers, 'body': ''}
+    
+    headers['Content-Type'] = 'text/html; charset=utf-8'
+    headers['Content-Security-Policy'] = INVOICE_CONTENT_SECURITY_POLICY
+    return {'statusCode': 200, 'headers': headers, 'body': invoice_html}
+
+def generate_invoice_batch(cur, items: list, issued_at: datetime):
+    '''Выдаёт номера на весь пакет разом и по одному рендерит счета, сохраняя их в БД страницами'''
+    numbers = next_invoice_numbers(issued_at.year, len(items))
+    page = []
+    
+    for item, counter in zip(items, numbers):
+        invoice_number = f"{issued_at.year}-{counter}"
+        invoice_html = render_invoice_html(invoice_number, item['userId'], item['username'], item['amount'], issued_at)
+        etag = invoice_etag(invoice_html)
+        access_token = secrets.token_urlsafe(24)
+        
+        page.append((invoice_number, str(item['userId']), item['username'], item['amount'], invoice_html, etag, access_token))
+        if len(page) >= INVOICE_BATCH_PAGE_SIZE:
+            save_invoices(cur, page)
+            page = []
+        
+        yield invoice_number, item, invoice_html, etag, access_token
+    
+    if page:
+        save_invoices(cur, page)
+
+class S3MultipartWriter(io.RawIOBase):
+    '''Файловый объект только для записи: копит данные и отправляет их в S3 частями multipart upload'''
+    
+    def __init__(self, s3, key: str, content_type: str, part_size: int = INVOICE_BATCH_PART_SIZE):
+        super().__init__()
+        self.s3 = s3
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.parts = []
+        self.size = 0
+        self.upload_id = s3.create_multipart_upload(Bucket=S3_BUCKET, Key=key, ContentType=content_type)['UploadId']
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, data) -> int:
+        self.buffer += data
+        self.size += len(data)
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+    
+    def _upload_part(self):
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(
+            Bucket=S3_BUCKET, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=bytes(self.buffer)
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = bytearray()
+    
+    def complete(self):
+        '''Отправляет остаток и собирает объект из частей'''
+        if self.buffer or not self.parts:
+            self._upload_part()
+        self.s3.complete_multipart_upload(
+            Bucket=S3_BUCKET, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+    
+    def abort(self):
+        '''Отменяет загрузку и удаляет уже отправленные части'''
+        self.s3.abort_multipart_upload(Bucket=S3_BUCKET, Key=self.key, UploadId=self.upload_id)
+
+def get_s3_client():
+    '''Клиент S3 хранилища проекта'''
+    return boto3.client('s3',
+        endpoint_url=S3_ENDPOINT_URL,
+        aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+    )
+
+def write_batch_ndjson(invoices, out):
+    '''Пишет счета в NDJSON: одна строка JSON на счёт'''
+    for invoice_number, item, invoice_html, etag, access_token in invoices:
+        out.write(json.dumps({
+            'invoiceNumber': invoice_number,
+            'userId': item['userId'],
+            'amount': item['amount'],
+            'etag': etag,
+            'accessToken': access_token,
+            'invoiceHtml': invoice_html
+        }, ensure_ascii=False).encode('utf-8'))
+        out.write(b'\n')
+
+def write_batch_zip(invoices, out):
+    '''Пишет счета в ZIP архив: по HTML файлу на счёт и manifest.ndjson с токенами доступа'''
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as archive, tempfile.TemporaryFile('w+', encoding='utf-8') as manifest:
+        for invoice_number, item, invoice_html, etag, access_token in invoices:
+            archive.writestr(f'invoice-{invoice_number}.html', invoice_html)
+            manifest.write(json.dumps({
+                'invoiceNumber': invoice_number,
+                'userId': item['userId'],
+                'amount': item['amount'],
+                'etag': etag,
+                'accessToken': access_token
+            }, ensure_ascii=False))
+            manifest.write('\n')
+        
+        # Манифест копируется из временного файла построчно, чтобы не держать его в памяти
+        manifest.seek(0)
+        with archive.open('manifest.ndjson', 'w') as entry:
+            for line in manifest:
+                entry.write(line.encode('utf-8'))
+
+def handle_batch(data: dict) -> dict:
+    '''Пакетная генерация счетов (например, ежемесячных для корпоративных клиентов) с выгрузкой результата в S3'''
+    items = data.get('invoices') or []
+    output_format = data.get('format', 'ndjson')
+    
+    error = None
+    if not items or not isinstance(items, list):
+        error = 'Не указан список счетов: invoices'
+    elif len(items) > INVOICE_BATCH_MAX_SIZE:
+        error = f'Слишком большой пакет: не более {INVOICE_BATCH_MAX_SIZE} счетов'
+    elif output_format not in ('ndjson', 'zip'):
+        error = 'Неверный формат. Допустимые: ndjson, zip'
+    else:
+        for index, item in enumerate(items):
+            if not isinstance(item, dict) or not all([item.get('userId'), item.get('username'), item.get('amount')]):
+                error = f'Счёт #{index}: не указаны обязательные поля: userId, username, amount'
+                break
+    
+    if error:
+        return {
+            'statusCode': 400,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': json.dumps({'error': error})
+        }
+    
+    issued_at = datetime.now()
+    content_type = 'application/zip' if output_format == 'zip' else 'application/x-ndjson; charset=utf-8'
+    key = f"invoices/batches/{issued_at.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex}.{output_format}"
+    
+    s3 = get_s3_client()
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        out = S3MultipartWriter(s3, key, content_type)
+        try:
+            invoices = generate_invoice_batch(cur, items, issued_at)
+            if output_format == 'zip':
+                write_batch_zip(invoices, out)
+            else:
+                write_batch_ndjson(invoices, out)
+            out.complete()
+        except Exception:
+            out.abort()
+            raise
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+    
+    print(f'[INVOICE_BATCH] Generated {len(items)} invoices as {output_format}, {out.size} bytes in {len(out.parts)} parts')
+    
+    # Документы содержат данные плательщиков, поэтому отдаём временную подписанную ссылку
+    url = s3.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': S3_BUCKET, 'Key': key},
+        ExpiresIn=INVOICE_BATCH_URL_TTL
+    )
+    
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps({
+            'success': True,
+            'count': len(items),
+            'format': output_format,
+            'size': out.size,
+            'url': url,
+            'expiresIn': INVOICE_BATCH_URL_TTL
+        })
+    }
+
+@with_profiling
+@with_compression
+def handler(event: dict, context) -> dict:
+    '''Генерация счёта на оплату для пополнения баланса клиента и выдача сохранённых счетов'''
+    
+    method = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, If-None-Match'
+            },
+            'body': ''
+        }
+    
+    if method not in ('GET', 'POST'):
+        return {
+            'statusCode': 405,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': json.dumps({'error': 'Метод не поддерживается'})
+        }
+    
+    try:
+        if method == 'GET':
+            return get_invoice(event)
+        
+        data = json.loads(event.get('body', '{}'))
+        
+        if data.get('action') == 'batch':
+            return handle_batch(data)
+        
+        user_id = data.get('userId')
+        username = data.get('username')
+        amount = data.get('amount')
+        
+        if not all([user_id, username, amount]):
+            return {
+                'statusCode': 400,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps({'error': 'Не указаны обязательные поля: userId, username, amount'})
+            }
+        
+        # Генерируем номер счёта в формате: текущий_год-порядковый_номер
+        issued_at = datetime.now()
+        counter = next_invoice_numbers(issued_at.year)[0]
+        invoice_number = f"{issued_at.year}-{counter}"
+        
+        invoice_html = render_invoice_html(invoice_number, user_id, username, amount, issued_at)
+        
+        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        try:
+            cur = conn.cursor()
+            etag = invoice_etag(invoice_html)
+            access_token = secrets.token_urlsafe(24)
+            save_invoices(cur, [(invoice_number, str(user_id), username, amount, invoice_html, etag, access_token)])
+            conn.commit()
+            cur.close()
+        finally:
+            conn.close()
         
         return {
             'statusCode': 200,
@@ -160,8 +527,10 @@ def handler(event: dict, context) -> dict:
                 'success': True,
                 'invoiceNumber': invoice_number,
                 'invoiceHtml': invoice_html,
+                'etag': etag,
+                'accessToken': access_token,
                 'amount': amount,
-                'date': datetime.now().isoformat()
+                'date': issued_at.isoformat()
             })
         }
     
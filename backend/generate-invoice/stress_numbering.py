@@ -0,0 +1,61 @@
+'''
+Нагрузочная проверка нумерации счетов на локальном Postgres.
+Несколько процессов (как несколько тёплых контейнеров) одновременно берут номера через
+next_invoice_numbers, скрипт проверяет уникальность номеров и считает пропускную способность.
+
+Запуск (таблица invoice_counters из db_migrations должна существовать):
+    DATABASE_URL=postgresql://localhost/test python stress_numbering.py --processes 8 --numbers 5000
+'''
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+def issue_numbers(args: tuple) -> list:
+    '''Выдаёт номера в отдельном процессе со своим локальным блоком'''
+    year, count = args
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import index
+    return [number for _ in range(count) for number in index.next_invoice_numbers(year)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--numbers', type=int, default=5000, help='номеров на процесс')
+    parser.add_argument('--block-size', type=int, default=50)
+    parser.add_argument('--year', type=int, default=9999, help='год счётчика, отдельный от рабочих')
+    args = parser.parse_args()
+
+    os.environ['INVOICE_BLOCK_SIZE'] = str(args.block_size)
+
+    import psycopg2
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cur = conn.cursor()
+    cur.execute('DELETE FROM invoice_counters WHERE year = %s', (args.year,))
+    conn.commit()
+
+    started = time.perf_counter()
+    with multiprocessing.get_context('spawn').Pool(args.processes) as pool:
+        results = pool.map(issue_numbers, [(args.year, args.numbers)] * args.processes)
+    elapsed = time.perf_counter() - started
+
+    numbers = [number for result in results for number in result]
+    duplicates = len(numbers) - len(set(numbers))
+    ordered = all(result == sorted(result) for result in results)
+
+    cur.execute('SELECT last_value FROM invoice_counters WHERE year = %s', (args.year,))
+    last_value = cur.fetchone()[0]
+    cur.execute('DELETE FROM invoice_counters WHERE year = %s', (args.year,))
+    conn.commit()
+    conn.close()
+
+    print(f'processes={args.processes} block={args.block_size} issued={len(numbers)} '
+          f'duplicates={duplicates} monotonic_per_process={ordered} reserved={last_value}')
+    print(f'throughput: {len(numbers) / elapsed:.0f} numbers/s ({elapsed:.2f} s)')
+
+    if duplicates or not ordered:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+'''
+Сжатие ответов функций по заголовку Accept-Encoding.
+Функции деплоятся независимо, поэтому модуль лежит копией в каталоге каждой функции.
+'''
+import base64
+import functools
+import gzip
+import json
+import os
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Ответы меньше порога не сжимаются: выигрыш не окупает CPU и заголовки
+COMPRESSION_MIN_SIZE = int(os.environ.get('RESPONSE_COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_LEVEL = int(os.environ.get('RESPONSE_COMPRESSION_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('RESPONSE_BROTLI_QUALITY', '5'))
+
+# action для логов берётся только из небольших тел, чтобы не разбирать JSON пакетов и картинок повторно
+LABEL_MAX_BODY_SIZE = 4096
+
+def get_header(headers: dict, name: str) -> str:
+    '''Возвращает значение заголовка без учёта регистра имени'''
+    for key, value in (headers or {}).items():
+        if key.lower() == name.lower():
+            return value
+    return ''
+
+def choose_encoding(accept_encoding: str):
+    '''Выбирает кодировку из Accept-Encoding с учётом q-значений: br (если доступен), затем gzip'''
+    weights = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        if coding:
+            weights[coding.strip().lower()] = weight
+
+    supported = (['br'] if brotli else []) + ['gzip']
+    for coding in sorted(supported, key=lambda c: -weights.get(c, weights.get('*', 0.0))):
+        if weights.get(coding, weights.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+def request_label(event: dict) -> str:
+    '''Метод и action запроса для логов'''
+    label = event.get('httpMethod', 'GET')
+    if len(event.get('body') or '') > LABEL_MAX_BODY_SIZE:
+        return label
+    try:
+        action = json.loads(event.get('body') or '{}').get('action')
+    except (ValueError, AttributeError):
+        action = None
+    return f'{label} {action}' if action else label
+
+def compress_response(event: dict, response: dict) -> dict:
+    '''Сжимает тело ответа, если клиент это поддерживает и тело больше порога'''
+    body = response.get('body')
+    headers = response.get('headers') or {}
+
+    if not body or response.get('isBase64Encoded') or get_header(headers, 'Content-Encoding'):
+        return response
+
+    raw = body.encode('utf-8') if isinstance(body, str) else body
+    if len(raw) < COMPRESSION_MIN_SIZE:
+        return response
+
+    encoding = choose_encoding(get_header(event.get('headers'), 'Accept-Encoding'))
+    if not encoding:
+        return response
+
+    started = time.process_time()
+    if encoding == 'br':
+        compressed = brotli.compress(raw, quality=BROTLI_QUALITY)
+    else:
+        compressed = gzip.compress(raw, compresslevel=COMPRESSION_LEVEL)
+    cpu_ms = (time.process_time() - started) * 1000
+
+    print(f'[COMPRESSION] {request_label(event)}: {encoding} {len(raw)} -> {len(compressed)} bytes '
+          f'(ratio {len(compressed) / len(raw):.3f}, cpu {cpu_ms:.2f} ms)')
+
+    if len(compressed) >= len(raw):
+        return response
+
+    headers = {**headers, 'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'}
+
+    # Сжатый вариант побайтно отличается от исходного, поэтому сильный ETag становится слабым
+    for key, value in headers.items():
+        if key.lower() == 'etag' and not value.startswith('W/'):
+            headers[key] = f'W/{value}'
+
+    return {
+        **response,
+        'headers': headers,
+        'body': base64.b64encode(compressed).decode('ascii'),
+        'isBase64Encoded': True
+    }
+
+def with_compression(handler):
+    '''Декоратор handler: сжимает ответы по Accept-Encoding'''
+    @functools.wraps(handler)
+    def wrapper(event: dict, context) -> dict:
+        return compress_response(event, handler(event, context))
+    return wrapper
@@ -3,7 +3,11 @@ import os
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from compression import with_compression
+from profiling import with_profiling
 
+@with_profiling
+@with_compression
 def handler(event: dict, context) -> dict:
     '''Отправка уведомлений о низком балансе на email и SMS'''
     method = event.get('httpMethod', 'POST')
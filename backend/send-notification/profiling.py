@@ -0,0 +1,117 @@
+'''
+Профилирование отдельных вызовов функции: cProfile и пик памяти tracemalloc.
+Включается для доли вызовов PROFILE_SAMPLE_RATE или заголовком X-Profile со значением PROFILE_TOKEN.
+Артефакты пишутся в PROFILE_OUTPUT_DIR, а при заданном PROFILE_S3_BUCKET копируются в S3.
+Функции деплоятся независимо, поэтому модуль лежит копией в каталоге каждой функции.
+'''
+import cProfile
+import functools
+import hmac
+import json
+import os
+import pstats
+import random
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+from compression import request_label
+
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+PROFILE_OUTPUT_DIR = os.environ.get('PROFILE_OUTPUT_DIR', '/tmp/profiles')
+PROFILE_S3_BUCKET = os.environ.get('PROFILE_S3_BUCKET', '')
+PROFILE_TOP = 25
+
+def should_profile(event: dict) -> bool:
+    '''Решает, профилировать ли вызов: по доле выборки или по заголовку с токеном'''
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return True
+    if not PROFILE_TOKEN:
+        return False
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == 'x-profile':
+            # Сравниваем байты: compare_digest отвергает строки с не-ASCII символами
+            return hmac.compare_digest(value.encode('utf-8'), PROFILE_TOKEN.encode('utf-8'))
+    return False
+
+def summarize(profiler: cProfile.Profile, snapshot, peak: int, duration: float, label: str) -> dict:
+    '''Краткая сводка: самые долгие функции по cumtime и самые крупные места выделения памяти'''
+    stats = pstats.Stats(profiler).stats
+    functions = sorted(stats.items(), key=lambda item: -item[1][3])[:PROFILE_TOP]
+    allocations = snapshot.statistics('lineno')[:PROFILE_TOP // 2]
+    return {
+        'request': label,
+        'durationMs': round(duration * 1000, 2),
+        'memoryPeakBytes': peak,
+        'functions': [
+            {
+                'function': f'{filename}:{line}({name})',
+                'calls': calls,
+                'tottimeMs': round(tottime * 1000, 3),
+                'cumtimeMs': round(cumtime * 1000, 3)
+            }
+            for (filename, line, name), (_, calls, tottime, cumtime, _) in functions
+        ],
+        'allocations': [
+            {'location': str(stat.traceback), 'bytes': stat.size, 'count': stat.count}
+            for stat in allocations
+        ]
+    }
+
+def write_artifacts(name: str, profiler: cProfile.Profile, summary: dict):
+    '''Пишет .prof (для pstats/snakeviz) и .json сводку на диск и при необходимости в S3'''
+    os.makedirs(PROFILE_OUTPUT_DIR, exist_ok=True)
+    prof_path = os.path.join(PROFILE_OUTPUT_DIR, f'{name}.prof')
+    json_path = os.path.join(PROFILE_OUTPUT_DIR, f'{name}.json')
+    profiler.dump_stats(prof_path)
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False)
+
+    if PROFILE_S3_BUCKET:
+        import boto3
+        s3 = boto3.client('s3',
+            endpoint_url=os.environ.get('S3_ENDPOINT_URL', 'https://bucket.poehali.dev'),
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+        )
+        for path in (prof_path, json_path):
+            s3.upload_file(path, PROFILE_S3_BUCKET, f'profiles/{os.path.basename(path)}')
+
+    print(f"[PROFILE] {summary['request']}: {summary['durationMs']} ms, "
+          f"peak {summary['memoryPeakBytes']} bytes -> {json_path}")
+
+def profile_call(handler, event: dict, context) -> dict:
+    '''Вызывает handler под cProfile и tracemalloc и сохраняет артефакты'''
+    function_name = getattr(context, 'function_name', None) or handler.__module__
+    name = f"{function_name}-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    profiler.enable()
+    try:
+        return handler(event, context)
+    finally:
+        profiler.disable()
+        duration = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        if not tracing:
+            tracemalloc.stop()
+        try:
+            write_artifacts(name, profiler, summarize(profiler, snapshot, peak, duration, request_label(event)))
+        except Exception as e:
+            print(f'[PROFILE] Failed to write artifacts: {type(e).__name__}: {e}')
+
+def with_profiling(handler):
+    '''Декоратор handler: профилирует выбранные вызовы, в остальных только проверяет условие'''
+    @functools.wraps(handler)
+    def wrapper(event: dict, context) -> dict:
+        if not should_profile(event):
+            return handler(event, context)
+        return profile_call(handler, event, context)
+    return wrapper
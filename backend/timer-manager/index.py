@@ -1,9 +1,27 @@
 import json
 import os
+import re
+import hmac
+import threading
 from datetime import datetime, timedelta
 from decimal import Decimal
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+from compression import with_compression
+from profiling import with_profiling
+
+# Чтение с реплики: включается переменной DATABASE_REPLICA_URL
+READ_ONLY_ACTIONS = {'get_topup_history'}
+REPLICA_MAX_LAG = float(os.environ.get('DATABASE_REPLICA_MAX_LAG', '5'))
+REPLICA_POOL_SIZE = int(os.environ.get('DATABASE_REPLICA_POOL_SIZE', '4'))
+LSN_PATTERN = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+
+# Общий секрет для вызовов между функциями (add_balance_bulk из crypto-payment)
+INTERNAL_API_TOKEN = os.environ.get('INTERNAL_API_TOKEN', '')
+
+_replica_pool = None
+_replica_pool_lock = threading.Lock()
 
 def decimal_to_float(obj):
     '''Конвертирует Decimal в float для JSON сериализации'''
@@ -73,281 +91,402 @@ def process_deductions(cur, conn):
     conn.commit()
     return {'processed': processed, 'deactivated': deactivated}
 
-def handler(event: dict, context) -> dict:
-    '''API для управления таймерами пользователей и автоматического списания'''
+def add_balance(cur, user_id, amount: float, admin_name: str, reference: str = None) -> dict:
+    '''Пополнение баланса пользователя: запись в историю и продление активного таймера.
+    Повторное пополнение с тем же reference не зачисляется, возвращается уже сохранённая запись.'''
+    print(f'[ADD_BALANCE] Start: user_id={user_id}, amount={amount}, admin={admin_name}, reference={reference}')
     
-    method = event.get('httpMethod', 'GET')
+    cur.execute('''
+        SELECT id FROM users WHERE id = %s
+    ''', (user_id,))
+    user = cur.fetchone()
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
-            'body': ''
-        }
+    if not user:
+        print(f'[ADD_BALANCE] User {user_id} not found, creating...')
+        cur.execute('''
+            INSERT INTO users (id, username) VALUES (%s, %s)
+        ''', (user_id, f'user{user_id}'))
+        print(f'[ADD_BALANCE] User {user_id} created')
+    else:
+        print(f'[ADD_BALANCE] User {user_id} exists')
     
-    try:
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+    print(f'[ADD_BALANCE] Inserting topup history...')
+    cur.execute('''
+        INSERT INTO topup_history (user_id, amount, admin_name, reference)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (reference) DO NOTHING
+        RETURNING id, user_id, amount, admin_name, reference, created_at
+    ''', (user_id, amount, admin_name, reference))
+    topup = cur.fetchone()
+    
+    if not topup:
+        cur.execute('''
+            SELECT id, user_id, amount, admin_name, reference, created_at
+            FROM topup_history WHERE reference = %s
+        ''', (reference,))
+        topup = cur.fetchone()
+        print(f'[ADD_BALANCE] Duplicate reference {reference}, already credited: id={topup["id"]}')
+        return {**topup, 'duplicate': True}
+    
+    print(f'[ADD_BALANCE] Topup history created: id={topup["id"]}')
+    
+    cur.execute('''
+        SELECT balance, coefficient FROM active_timers 
+        WHERE user_id = %s AND is_active = TRUE
+    ''', (user_id,))
+    timer = cur.fetchone()
+    
+    if timer:
+        print(f'[ADD_BALANCE] Active timer found: balance={timer["balance"]}, coefficient={timer["coefficient"]}')
+        new_balance = float(timer['balance']) + amount
+        coefficient = float(timer['coefficient'])
+        
+        additional_minutes = amount / coefficient if coefficient > 0 else 0
+        print(f'[ADD_BALANCE] Updating timer: new_balance={new_balance}, additional_minutes={additional_minutes}')
+        
+        cur.execute('''
+            UPDATE active_timers
+            SET balance = %s,
+                timer_end_date = timer_end_date + make_interval(mins => %s),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = %s AND is_active = TRUE
+        ''', (new_balance, additional_minutes, user_id))
+        print(f'[ADD_BALANCE] Timer updated successfully')
+    else:
+        print(f'[ADD_BALANCE] No active timer for user {user_id}')
+    
+    return topup
+
+def get_replica_pool():
+    '''Пул соединений с репликой, None если реплика не настроена.
+    Пул создаётся без начальных соединений: недоступная реплика проявится в getconn, а не здесь.'''
+    global _replica_pool
+    if _replica_pool is None and os.environ.get('DATABASE_REPLICA_URL'):
+        with _replica_pool_lock:
+            if _replica_pool is None:
+                _replica_pool = ThreadedConnectionPool(0, REPLICA_POOL_SIZE, os.environ['DATABASE_REPLICA_URL'])
+    return _replica_pool
+
+def get_header(event: dict, name: str) -> str:
+    '''Возвращает значение заголовка запроса без учёта регистра имени'''
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name.lower():
+            return value
+    return ''
+
+def replica_is_fresh(conn, min_lsn) -> bool:
+    '''Проверяет, что отставание реплики в пределах REPLICA_MAX_LAG и она догнала запись клиента (min_lsn)'''
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT
+            CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                 ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+            END,
+            %s::pg_lsn IS NULL OR pg_last_wal_replay_lsn() >= %s::pg_lsn
+    ''', (min_lsn, min_lsn))
+    lag, caught_up = cur.fetchone()
+    cur.close()
+    
+    if float(lag) > REPLICA_MAX_LAG or not caught_up:
+        print(f'[REPLICA] Falling back to primary: lag={float(lag):.1f}s, caught_up={caught_up}')
+        return False
+    return True
+
+def open_connection(event: dict, read_only: bool) -> tuple:
+    '''Соединение для запроса: чтение идёт на реплику, если она свежая, иначе на основную БД. Возвращает (conn, pooled)'''
+    if read_only and os.environ.get('DATABASE_REPLICA_URL'):
+        # Клиент передаёт X-Min-Lsn из X-Write-Lsn своей последней записи (read-your-writes)
+        min_lsn = get_header(event, 'X-Min-Lsn')
+        min_lsn = min_lsn if LSN_PATTERN.match(min_lsn) else None
         
-        if method == 'GET':
-            user_id = event.get('queryStringParameters', {}).get('user_id')
+        pool = conn = None
+        try:
+            pool = get_replica_pool()
+            conn = pool.getconn()
+            conn.set_session(readonly=True, autocommit=True)
+            if replica_is_fresh(conn, min_lsn):
+                return conn, True
+            pool.putconn(conn)
+        except psycopg2.Error as e:
+            print(f'[REPLICA] Unavailable, falling back to primary: {type(e).__name__}: {e}')
+            if conn is not None:
+                pool.putconn(conn, close=True)
+    
+    return psycopg2.connect(os.environ['DATABASE_URL']), False
+
+def route_request(event: dict, method: str, body: dict, cur, conn) -> dict:
+    '''Обработка запроса по методу и action на открытом соединении'''
+    if method == 'GET':
+        user_id = event.get('queryStringParameters', {}).get('user_id')
+        
+        if user_id:
+            cur.execute('''
+                SELECT u.*, at.balance, at.coefficient, at.timer_end_date, 
+                       at.is_active, at.last_deduction_time
+                FROM users u
+                LEFT JOIN active_timers at ON u.id = at.user_id AND at.is_active = TRUE
+                WHERE u.id = %s
+            ''', (user_id,))
+            user = cur.fetchone()
             
-            if user_id:
-                cur.execute('''
-                    SELECT u.*, at.balance, at.coefficient, at.timer_end_date, 
-                           at.is_active, at.last_deduction_time
-                    FROM users u
-                    LEFT JOIN active_timers at ON u.id = at.user_id AND at.is_active = TRUE
-                    WHERE u.id = %s
-                ''', (user_id,))
-                user = cur.fetchone()
-                
-                if not user:
-                    return {
-                        'statusCode': 404,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'User not found'})
-                    }
-                
-                result = decimal_to_float(dict(user))
-                    
+            if not user:
                 return {
-                    'statusCode': 200,
+                    'statusCode': 404,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(result)
+                    'body': json.dumps({'error': 'User not found'})
                 }
-            else:
-                cur.execute('''
-                    SELECT u.*, at.balance, at.coefficient, at.timer_end_date, 
-                           at.is_active, at.last_deduction_time
-                    FROM users u
-                    LEFT JOIN active_timers at ON u.id = at.user_id AND at.is_active = TRUE
-                    ORDER BY u.id
-                ''')
-                users = cur.fetchall()
-                
-                result = [decimal_to_float(dict(user)) for user in users]
+            
+            result = decimal_to_float(dict(user))
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(result)
-                }
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps(result)
+            }
+        else:
+            cur.execute('''
+                SELECT u.*, at.balance, at.coefficient, at.timer_end_date, 
+                       at.is_active, at.last_deduction_time
+                FROM users u
+                LEFT JOIN active_timers at ON u.id = at.user_id AND at.is_active = TRUE
+                ORDER BY u.id
+            ''')
+            users = cur.fetchall()
+            
+            result = [decimal_to_float(dict(user)) for user in users]
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps(result)
+            }
+    
+    elif method == 'POST':
+        action = body.get('action')
         
-        elif method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            action = body.get('action')
+        if action == 'create_user':
+            username = body.get('username')
+            email = body.get('email', '')
+            phone = body.get('phone', '')
             
-            if action == 'create_user':
-                username = body.get('username')
-                email = body.get('email', '')
-                phone = body.get('phone', '')
-                
-                cur.execute('''
-                    INSERT INTO users (username, email, phone)
-                    VALUES (%s, %s, %s)
-                    RETURNING id, username, email, phone, created_at
-                ''', (username, email, phone))
-                user = cur.fetchone()
-                conn.commit()
-                
-                result = decimal_to_float(dict(user))
-                
-                return {
-                    'statusCode': 201,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(result)
-                }
+            cur.execute('''
+                INSERT INTO users (username, email, phone)
+                VALUES (%s, %s, %s)
+                RETURNING id, username, email, phone, created_at
+            ''', (username, email, phone))
+            user = cur.fetchone()
+            conn.commit()
             
-            elif action == 'add_balance':
-                user_id = body.get('user_id')
-                amount = float(body.get('amount', 0))
-                admin_name = body.get('admin_name', 'admin')
-                
-                print(f'[ADD_BALANCE] Start: user_id={user_id}, amount={amount}, admin={admin_name}')
-                
-                cur.execute('''
-                    SELECT id FROM users WHERE id = %s
-                ''', (user_id,))
-                user = cur.fetchone()
-                
-                if not user:
-                    print(f'[ADD_BALANCE] User {user_id} not found, creating...')
-                    cur.execute('''
-                        INSERT INTO users (id, username) VALUES (%s, %s)
-                    ''', (user_id, f'user{user_id}'))
-                    conn.commit()
-                    print(f'[ADD_BALANCE] User {user_id} created')
-                else:
-                    print(f'[ADD_BALANCE] User {user_id} exists')
-                
-                print(f'[ADD_BALANCE] Inserting topup history...')
-                cur.execute('''
-                    INSERT INTO topup_history (user_id, amount, admin_name)
-                    VALUES (%s, %s, %s)
-                    RETURNING id, user_id, amount, admin_name, created_at
-                ''', (user_id, amount, admin_name))
-                topup = cur.fetchone()
-                print(f'[ADD_BALANCE] Topup history created: id={topup["id"]}')
-                
-                cur.execute('''
-                    SELECT balance, coefficient FROM active_timers 
-                    WHERE user_id = %s AND is_active = TRUE
-                ''', (user_id,))
-                timer = cur.fetchone()
-                
-                if timer:
-                    print(f'[ADD_BALANCE] Active timer found: balance={timer["balance"]}, coefficient={timer["coefficient"]}')
-                    new_balance = float(timer['balance']) + amount
-                    coefficient = float(timer['coefficient'])
-                    
-                    additional_minutes = amount / coefficient if coefficient > 0 else 0
-                    print(f'[ADD_BALANCE] Updating timer: new_balance={new_balance}, additional_minutes={additional_minutes}')
-                    
-                    cur.execute('''
-                        UPDATE active_timers
-                        SET balance = %s,
-                            timer_end_date = timer_end_date + make_interval(mins => %s),
-                            updated_at = CURRENT_TIMESTAMP
-                        WHERE user_id = %s AND is_active = TRUE
-                    ''', (new_balance, additional_minutes, user_id))
-                    print(f'[ADD_BALANCE] Timer updated successfully')
-                else:
-                    print(f'[ADD_BALANCE] No active timer for user {user_id}')
-                
-                conn.commit()
-                print(f'[ADD_BALANCE] Transaction committed successfully')
-                
-                result = decimal_to_float(dict(topup))
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(result)
-                }
+            result = decimal_to_float(dict(user))
             
-            elif action == 'start_timer':
-                user_id = body.get('user_id')
-                balance = float(body.get('balance', 0))
-                coefficient = float(body.get('coefficient', 1))
-                
-                total_minutes = balance / coefficient if coefficient > 0 else 0
-                timer_end_date = datetime.now() + timedelta(minutes=total_minutes)
-                
-                cur.execute('''
-                    INSERT INTO active_timers (user_id, balance, coefficient, timer_end_date)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT (user_id) 
-                    DO UPDATE SET 
-                        balance = EXCLUDED.balance,
-                        coefficient = EXCLUDED.coefficient,
-                        timer_end_date = EXCLUDED.timer_end_date,
-                        is_active = TRUE,
-                        last_deduction_time = CURRENT_TIMESTAMP,
-                        updated_at = CURRENT_TIMESTAMP
-                    RETURNING id, user_id, balance, coefficient, timer_end_date
-                ''', (user_id, balance, coefficient, timer_end_date))
-                timer = cur.fetchone()
-                conn.commit()
-                
-                result = decimal_to_float(dict(timer))
-                
-                return {
-                    'statusCode': 201,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(result)
-                }
+            return {
+                'statusCode': 201,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps(result)
+            }
+        
+        elif action == 'add_balance':
+            user_id = body.get('user_id')
+            amount = float(body.get('amount', 0))
+            admin_name = body.get('admin_name', 'admin')
             
-            elif action == 'process_deductions':
-                result = process_deductions(cur, conn)
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'success': True,
-                        'processed': result['processed'],
-                        'deactivated': result['deactivated'],
-                        'timestamp': datetime.now().isoformat()
-                    })
-                }
+            topup = add_balance(cur, user_id, amount, admin_name)
+            conn.commit()
+            print(f'[ADD_BALANCE] Transaction committed successfully')
             
-            elif action == 'get_topup_history':
-                user_id = body.get('user_id')
-                
-                print(f'[GET_TOPUP_HISTORY] Start: user_id={user_id}')
-                
-                if user_id:
-                    cur.execute('''
-                        SELECT id, user_id, amount, admin_name, created_at
-                        FROM topup_history
-                        WHERE user_id = %s
-                        ORDER BY created_at DESC
-                    ''', (user_id,))
-                else:
-                    cur.execute('''
-                        SELECT th.id, th.user_id, th.amount, th.admin_name, th.created_at, u.username
-                        FROM topup_history th
-                        LEFT JOIN users u ON th.user_id = u.id
-                        ORDER BY th.created_at DESC
-                        LIMIT 100
-                    ''')
-                
-                history = cur.fetchall()
-                print(f'[GET_TOPUP_HISTORY] Found {len(history)} records')
-                
-                result = [decimal_to_float(dict(record)) for record in history]
-                
+            result = decimal_to_float(dict(topup))
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps(result)
+            }
+        
+        elif action == 'add_balance_bulk':
+            token = get_header(event, 'X-Internal-Token')
+            if not INTERNAL_API_TOKEN or not hmac.compare_digest(token.encode('utf-8'), INTERNAL_API_TOKEN.encode('utf-8')):
                 return {
-                    'statusCode': 200,
+                    'statusCode': 403,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(result)
+                    'body': json.dumps({'error': 'Доступ запрещён'})
                 }
+            
+            items = body.get('items', [])
+            
+            print(f'[ADD_BALANCE_BULK] Start: {len(items)} items')
+            
+            topups = [
+                add_balance(cur, item.get('user_id'), float(item.get('amount', 0)), item.get('admin_name', 'admin'),
+                            item.get('reference'))
+                for item in items
+            ]
+            conn.commit()
+            print(f'[ADD_BALANCE_BULK] Transaction committed successfully')
+            
+            result = [decimal_to_float(dict(topup)) for topup in topups]
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps(result)
+            }
         
-        elif method == 'PUT':
-            body = json.loads(event.get('body', '{}'))
+        elif action == 'start_timer':
             user_id = body.get('user_id')
+            balance = float(body.get('balance', 0))
+            coefficient = float(body.get('coefficient', 1))
             
-            updates = []
-            params = []
+            total_minutes = balance / coefficient if coefficient > 0 else 0
+            timer_end_date = datetime.now() + timedelta(minutes=total_minutes)
             
-            if 'email' in body:
-                updates.append('email = %s')
-                params.append(body['email'])
-            if 'phone' in body:
-                updates.append('phone = %s')
-                params.append(body['phone'])
-            if 'coefficient' in body:
+            cur.execute('''
+                INSERT INTO active_timers (user_id, balance, coefficient, timer_end_date)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (user_id) 
+                DO UPDATE SET 
+                    balance = EXCLUDED.balance,
+                    coefficient = EXCLUDED.coefficient,
+                    timer_end_date = EXCLUDED.timer_end_date,
+                    is_active = TRUE,
+                    last_deduction_time = CURRENT_TIMESTAMP,
+                    updated_at = CURRENT_TIMESTAMP
+                RETURNING id, user_id, balance, coefficient, timer_end_date
+            ''', (user_id, balance, coefficient, timer_end_date))
+            timer = cur.fetchone()
+            conn.commit()
+            
+            result = decimal_to_float(dict(timer))
+            
+            return {
+                'statusCode': 201,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps(result)
+            }
+        
+        elif action == 'process_deductions':
+            result = process_deductions(cur, conn)
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': True,
+                    'processed': result['processed'],
+                    'deactivated': result['deactivated'],
+                    'timestamp': datetime.now().isoformat()
+                })
+            }
+        
+        elif action == 'get_topup_history':
+            user_id = body.get('user_id')
+            
+            print(f'[GET_TOPUP_HISTORY] Start: user_id={user_id}')
+            
+            if user_id:
                 cur.execute('''
-                    UPDATE active_timers 
-                    SET coefficient = %s, updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id = %s AND is_active = TRUE
-                ''', (float(body['coefficient']), user_id))
+                    SELECT id, user_id, amount, admin_name, created_at
+                    FROM topup_history
+                    WHERE user_id = %s
+                    ORDER BY created_at DESC
+                ''', (user_id,))
+            else:
+                cur.execute('''
+                    SELECT th.id, th.user_id, th.amount, th.admin_name, th.created_at, u.username
+                    FROM topup_history th
+                    LEFT JOIN users u ON th.user_id = u.id
+                    ORDER BY th.created_at DESC
+                    LIMIT 100
+                ''')
             
-            if updates:
-                params.append(user_id)
-                cur.execute(f'''
-                    UPDATE users 
-                    SET {', '.join(updates)}, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = %s
-                ''', params)
+            history = cur.fetchall()
+            print(f'[GET_TOPUP_HISTORY] Found {len(history)} records')
             
-            conn.commit()
+            result = [decimal_to_float(dict(record)) for record in history]
             
             return {
                 'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True})
+                'body': json.dumps(result)
             }
+    
+    elif method == 'PUT':
+        user_id = body.get('user_id')
+        
+        updates = []
+        params = []
+        
+        if 'email' in body:
+            updates.append('email = %s')
+            params.append(body['email'])
+        if 'phone' in body:
+            updates.append('phone = %s')
+            params.append(body['phone'])
+        if 'coefficient' in body:
+            cur.execute('''
+                UPDATE active_timers 
+                SET coefficient = %s, updated_at = CURRENT_TIMESTAMP
+                WHERE user_id = %s AND is_active = TRUE
+            ''', (float(body['coefficient']), user_id))
+        
+        if updates:
+            params.append(user_id)
+            cur.execute(f'''
+                UPDATE users 
+                SET {', '.join(updates)}, updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+            ''', params)
+        
+        conn.commit()
         
         return {
-            'statusCode': 405,
+            'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'})
+            'body': json.dumps({'success': True})
         }
+    
+    return {
+        'statusCode': 405,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'error': 'Method not allowed'})
+    }
+
+
+@with_profiling
+@with_compression
+def handler(event: dict, context) -> dict:
+    '''API для управления таймерами пользователей и автоматического списания'''
+    
+    method = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Min-Lsn'
+            },
+            'body': ''
+        }
+    
+    try:
+        body = json.loads(event.get('body', '{}')) if method in ('POST', 'PUT') else {}
+        read_only = method == 'GET' or (method == 'POST' and body.get('action') in READ_ONLY_ACTIONS)
+        
+        conn, pooled = open_connection(event, read_only)
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        
+        response = route_request(event, method, body, cur, conn)
+        
+        # После записи сообщаем клиенту позицию WAL, чтобы его следующие чтения не ушли на отстающую реплику.
+        # Запись уже зафиксирована: ошибка здесь не должна превращаться в 500, иначе повтор клиента её удвоит
+        if not read_only and os.environ.get('DATABASE_REPLICA_URL') and response['statusCode'] < 400:
+            try:
+                cur.execute('SELECT pg_current_wal_lsn()::text AS lsn')
+                response['headers'] = {**response['headers'], 'X-Write-Lsn': cur.fetchone()['lsn'], 'Access-Control-Expose-Headers': 'X-Write-Lsn'}
+            except psycopg2.Error as e:
+                print(f'[REPLICA] Failed to read write LSN: {type(e).__name__}: {e}')
+        
+        return response
         
     except Exception as e:
         print(f'[ERROR] Exception occurred: {type(e).__name__}: {str(e)}')
@@ -362,4 +501,7 @@ def handler(event: dict, context) -> dict:
         if 'cur' in locals():
             cur.close()
         if 'conn' in locals():
-            conn.close()
\ No newline at end of file
+            if pooled:
+                get_replica_pool().putconn(conn)
+            else:
+                conn.close()
\ No newline at end of file
@@ -0,0 +1,93 @@
+'''
+Оптимизация изображений подписи и печати: определение формата по содержимому,
+уменьшение до размера в шаблоне счёта и перекодирование в самый компактный из PNG и WebP
+(исходный файл сохраняется как есть, если он уже подходит и меньше).
+'''
+import io
+import os
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Высота изображений в шаблоне счёта (CSS px) и запас плотности для HiDPI экранов и печати
+TEMPLATE_HEIGHTS = {'signature': 60, 'stamp': 120}
+PIXEL_DENSITY = 3
+
+# Предел размера до декодирования: подписи и печати не бывают больше нескольких мегапикселей
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', str(40_000_000)))
+
+# Форматы, которые можно хранить без перекодирования
+ORIGINAL_FORMATS = {'PNG': ('image/png', 'png'), 'JPEG': ('image/jpeg', 'jpg'), 'WEBP': ('image/webp', 'webp')}
+EXIF_ORIENTATION = 0x0112
+
+class InvalidImageError(ValueError):
+    '''Файл не удаётся декодировать как изображение'''
+
+def detect_content_type(data: bytes):
+    '''MIME тип изображения по сигнатуре файла, None для неподдерживаемых форматов'''
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    return None
+
+def optimize_image(data: bytes, image_type: str) -> tuple:
+    '''Возвращает (байты, MIME тип, расширение) самого компактного варианта изображения'''
+    try:
+        source = Image.open(io.BytesIO(data))
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise InvalidImageError(f'Не удалось прочитать изображение: {e}') from e
+
+    # Размер известен из заголовка до декодирования: маленький файл может распаковаться в сотни МБ
+    if source.width * source.height > IMAGE_MAX_PIXELS:
+        raise InvalidImageError(f'Изображение больше {IMAGE_MAX_PIXELS // 1_000_000} Мпикс')
+
+    # Высота в шаблоне считается после поворота по EXIF: при 5-8 стороны меняются местами
+    try:
+        orientation = source.getexif().get(EXIF_ORIENTATION, 1)
+    except OSError as e:
+        raise InvalidImageError(f'Не удалось прочитать изображение: {e}') from e
+    rotated = orientation in (5, 6, 7, 8)
+    display_height = source.width if rotated else source.height
+    max_height = TEMPLATE_HEIGHTS[image_type] * PIXEL_DENSITY
+    scale = min(1.0, max_height / display_height)
+    size = (max(1, round(source.width * scale)), max(1, round(source.height * scale)))
+
+    # Исходник подходит без изменений, только если его не нужно поворачивать и уменьшать
+    original_type = ORIGINAL_FORMATS.get(source.format) if orientation == 1 and scale == 1.0 else None
+
+    has_alpha = source.mode in ('RGBA', 'LA', 'PA') or 'transparency' in source.info
+    mode = 'RGBA' if has_alpha else 'RGB'
+
+    try:
+        # JPEG декодируется сразу в уменьшенном масштабе (1/2-1/8), остальные форматы - целиком
+        source.draft(source.mode, size)
+        source.load()
+    except (Image.DecompressionBombError, OSError) as e:
+        raise InvalidImageError(f'Не удалось прочитать изображение: {e}') from e
+
+    # Палитра и редкие режимы уменьшаются только NEAREST, поэтому их переводим в RGB(A) заранее
+    image = source if source.mode in ('RGB', 'RGBA', 'L', 'LA') else source.convert(mode)
+    if image.size != size:
+        # reducing_gap сначала сжимает целым множителем (reduce), полноразмерная копия не создаётся
+        image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+    if image.mode != mode:
+        image = image.convert(mode)
+    image = ImageOps.exif_transpose(image) if orientation != 1 else image
+
+    # Подпись и печать - плоская графика: lossless WebP часто меньше lossy, поэтому пробуем оба
+    candidates = [
+        ('PNG', {'optimize': True}, 'image/png', 'png'),
+        ('WEBP', {'lossless': True}, 'image/webp', 'webp'),
+        ('WEBP', {'quality': 90, 'method': 4}, 'image/webp', 'webp')
+    ]
+    # Исходник идёт первым: при равном размере он выигрывает и не теряет качество
+    results = [(data, *original_type)] if original_type else []
+    for image_format, options, content_type, extension in candidates:
+        buffer = io.BytesIO()
+        image.save(buffer, image_format, **options)
+        results.append((buffer.getvalue(), content_type, extension))
+
+    return min(results, key=lambda result: len(result[0]))
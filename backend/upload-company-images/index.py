@@ -1,9 +1,243 @@
 import json
 import os
 import base64
+import hashlib
+import hmac
+import uuid
+from datetime import datetime, timedelta, timezone
 import boto3
-from datetime import datetime
+from botocore.exceptions import ClientError
+from compression import with_compression
+from profiling import with_profiling
+from images import detect_content_type, optimize_image, InvalidImageError
 
+# Хранилище: endpoint можно переопределить локальным S3 (MinIO, moto_server)
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', 'https://bucket.poehali.dev')
+S3_BUCKET = 'files'
+
+# Прямая загрузка в S3 по подписанной POST-форме: срок жизни формы и допустимые форматы
+UPLOAD_URL_TTL = int(os.environ.get('UPLOAD_URL_TTL', '300'))
+MAX_UPLOAD_SIZE = int(os.environ.get('MAX_UPLOAD_SIZE', str(5 * 1024 * 1024)))
+UPLOAD_CONTENT_TYPES = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/webp': 'webp'}
+UPLOAD_PREFIX = 'company/uploads/'
+
+# presign и confirm открыты так же, как загрузка base64 со страницы настроек;
+# служебное действие sweep (вызывается по расписанию) требует заголовок X-Upload-Token
+UPLOAD_TOKEN = os.environ.get('UPLOAD_TOKEN', '')
+
+# Неподтверждённые загрузки старше UPLOAD_SWEEP_GRACE секунд удаляет действие sweep (вызывать по расписанию).
+# Вместо него можно задать правило жизненного цикла бакета: Expiration 1 день для префикса company/uploads/
+UPLOAD_SWEEP_GRACE = int(os.environ.get('UPLOAD_SWEEP_GRACE', '3600'))
+
+# Ключи объектов уникальны (хэш или uuid), поэтому содержимое по ключу никогда не меняется
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Указатели "хэш исходного файла -> сохранённый объект": повторная загрузка не декодируется заново
+SOURCE_PREFIX = 'company/sources/'
+
+def get_s3_client():
+    '''Клиент S3 хранилища проекта'''
+    return boto3.client('s3',
+        endpoint_url=S3_ENDPOINT_URL,
+        aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+    )
+
+def object_exists(s3, key: str) -> bool:
+    '''Проверяет наличие объекта в хранилище'''
+    try:
+        s3.head_object(Bucket=S3_BUCKET, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+def cdn_url(key: str) -> str:
+    '''Публичный URL объекта (CDN_BASE_URL позволяет указать адрес локального хранилища)'''
+    base_url = os.environ.get('CDN_BASE_URL', f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket")
+    return f'{base_url}/{key}'
+
+def get_header(event: dict, name: str) -> str:
+    '''Возвращает значение заголовка запроса без учёта регистра имени'''
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name.lower():
+            return value
+    return ''
+
+def error_response(status: int, message: str) -> dict:
+    '''JSON ответ с ошибкой'''
+    return {
+        'statusCode': status,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps({'error': message})
+    }
+
+def load_source(s3, key: str):
+    '''Читает указатель на уже обработанное изображение, None если его нет'''
+    try:
+        return json.loads(s3.get_object(Bucket=S3_BUCKET, Key=key)['Body'].read())
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+
+def store_image(s3, image_type: str, image_data: bytes) -> dict:
+    '''Оптимизирует и сохраняет изображение под ключом по хэшу содержимого.
+    Возвращает {key, storedBytes, deduplicated}; для уже загружавшегося файла обработка пропускается.'''
+    source_key = f'{SOURCE_PREFIX}{image_type}-{hashlib.sha256(image_data).hexdigest()[:32]}.json'
+    source = load_source(s3, source_key)
+    if source:
+        return {**source, 'deduplicated': True}
+    
+    # Уменьшаем под размер в шаблоне счёта и перекодируем
+    optimized_data, content_type, extension = optimize_image(image_data, image_type)
+    
+    # Имя файла по хэшу результата: разные исходники с одинаковым результатом хранятся один раз
+    content_hash = hashlib.sha256(optimized_data).hexdigest()[:32]
+    key = f'company/{image_type}-{content_hash}.{extension}'
+    
+    deduplicated = object_exists(s3, key)
+    if not deduplicated:
+        s3.put_object(
+            Bucket=S3_BUCKET,
+            Key=key,
+            Body=optimized_data,
+            ContentType=content_type,
+            CacheControl=IMMUTABLE_CACHE_CONTROL
+        )
+    
+    source = {'key': key, 'storedBytes': len(optimized_data)}
+    s3.put_object(Bucket=S3_BUCKET, Key=source_key, Body=json.dumps(source), ContentType='application/json')
+    return {**source, 'deduplicated': deduplicated}
+
+def presign_upload(image_type: str, content_type: str) -> dict:
+    '''Выдаёт короткоживущую подписанную POST-форму для загрузки изображения напрямую в S3.
+    Условия формы ограничивают размер, тип и Cache-Control, в отличие от подписанного PUT.'''
+    if content_type not in UPLOAD_CONTENT_TYPES:
+        return error_response(400, f"Неверный формат изображения. Допустимые: {', '.join(UPLOAD_CONTENT_TYPES)}")
+    
+    key = f'{UPLOAD_PREFIX}{image_type}-{uuid.uuid4().hex}.{UPLOAD_CONTENT_TYPES[content_type]}'
+    form = get_s3_client().generate_presigned_post(
+        Bucket=S3_BUCKET,
+        Key=key,
+        Fields={'Content-Type': content_type, 'Cache-Control': IMMUTABLE_CACHE_CONTROL},
+        Conditions=[
+            {'Content-Type': content_type},
+            {'Cache-Control': IMMUTABLE_CACHE_CONTROL},
+            ['content-length-range', 1, MAX_UPLOAD_SIZE]
+        ],
+        ExpiresIn=UPLOAD_URL_TTL
+    )
+    
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps({
+            'success': True,
+            'uploadUrl': form['url'],
+            'method': 'POST',
+            'fields': form['fields'],
+            'key': key,
+            'maxSize': MAX_UPLOAD_SIZE,
+            'expiresIn': UPLOAD_URL_TTL
+        })
+    }
+
+def confirm_upload(image_type: str, key: str) -> dict:
+    '''Забирает изображение, загруженное по подписанной форме, прогоняет через оптимизацию и возвращает его URL'''
+    if not key.startswith(f'{UPLOAD_PREFIX}{image_type}-'):
+        return error_response(400, 'Неверный ключ загрузки')
+    
+    s3 = get_s3_client()
+    try:
+        head = s3.head_object(Bucket=S3_BUCKET, Key=key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return error_response(400, 'Изображение не загружено')
+        raise
+    
+    rejected = error_response(400, f'Изображение отклонено: допустимы PNG, JPEG, WebP до {MAX_UPLOAD_SIZE // (1024 * 1024)} МБ')
+    if head['ContentLength'] > MAX_UPLOAD_SIZE or head.get('ContentType') not in UPLOAD_CONTENT_TYPES:
+        s3.delete_object(Bucket=S3_BUCKET, Key=key)
+        return rejected
+    
+    # Компромисс: ради оптимизации байты один раз проходят через функцию. Память ограничена
+    # MAX_UPLOAD_SIZE (условие формы, HEAD и Range на случай подмены объекта) и IMAGE_MAX_PIXELS
+    # при декодировании; прямая загрузка по-прежнему избавляет запрос от base64 и лимита тела
+    image_data = s3.get_object(Bucket=S3_BUCKET, Key=key, Range=f'bytes=0-{MAX_UPLOAD_SIZE}')['Body'].read()
+    if len(image_data) > MAX_UPLOAD_SIZE:
+        s3.delete_object(Bucket=S3_BUCKET, Key=key)
+        return rejected
+    
+    # Заявленный при загрузке Content-Type не доверяем: формат проверяется по содержимому
+    if detect_content_type(image_data) not in UPLOAD_CONTENT_TYPES:
+        s3.delete_object(Bucket=S3_BUCKET, Key=key)
+        return rejected
+    
+    try:
+        stored = store_image(s3, image_type, image_data)
+    except InvalidImageError as e:
+        s3.delete_object(Bucket=S3_BUCKET, Key=key)
+        return error_response(400, str(e))
+    
+    # Временный объект больше не нужен: изображение хранится под ключом по хэшу содержимого
+    s3.delete_object(Bucket=S3_BUCKET, Key=key)
+    
+    saved_bytes = len(image_data) - stored['storedBytes']
+    print(f"[UPLOAD] {key} -> {stored['key']}: {len(image_data)} -> {stored['storedBytes']} bytes, "
+          f"saved {saved_bytes}, deduplicated={stored['deduplicated']}")
+    
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps({
+            'success': True,
+            'url': cdn_url(stored['key']),
+            'type': image_type,
+            'originalBytes': len(image_data),
+            'storedBytes': stored['storedBytes'],
+            'savedBytes': saved_bytes,
+            'deduplicated': stored['deduplicated'],
+            'message': 'Изображение успешно загружено'
+        })
+    }
+
+def sweep_uploads() -> dict:
+    '''Удаляет загрузки по подписанной форме, которые не подтвердили в течение UPLOAD_SWEEP_GRACE секунд'''
+    s3 = get_s3_client()
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=UPLOAD_SWEEP_GRACE)
+    
+    stale = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=S3_BUCKET, Prefix=UPLOAD_PREFIX):
+        stale.extend({'Key': obj['Key']} for obj in page.get('Contents', []) if obj['LastModified'] < cutoff)
+    
+    # delete_objects принимает не больше 1000 ключей за запрос
+    for start in range(0, len(stale), 1000):
+        s3.delete_objects(Bucket=S3_BUCKET, Delete={'Objects': stale[start:start + 1000], 'Quiet': True})
+    
+    print(f'[SWEEP] Deleted {len(stale)} unconfirmed uploads older than {UPLOAD_SWEEP_GRACE} s')
+    
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps({'success': True, 'deleted': len(stale)})
+    }
+
+@with_profiling
+@with_compression
 def handler(event: dict, context) -> dict:
     '''Загрузка изображений печати и подписи компании в S3 хранилище'''
     
@@ -15,7 +249,7 @@ def handler(event: dict, context) -> dict:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
+                'Access-Control-Allow-Headers': 'Content-Type, X-Upload-Token'
             },
             'body': ''
         }
@@ -32,9 +266,23 @@ def handler(event: dict, context) -> dict:
     
     try:
         data = json.loads(event.get('body', '{}'))
+        action = data.get('action')
         image_type = data.get('type')
         image_base64 = data.get('image')
         
+        if action == 'sweep':
+            token = get_header(event, 'X-Upload-Token')
+            if not UPLOAD_TOKEN or not hmac.compare_digest(token.encode('utf-8'), UPLOAD_TOKEN.encode('utf-8')):
+                return error_response(403, 'Доступ запрещён')
+            return sweep_uploads()
+        
+        if action in ('presign', 'confirm'):
+            if image_type not in ['signature', 'stamp']:
+                return error_response(400, 'Неверный тип изображения. Допустимые: signature, stamp')
+            if action == 'presign':
+                return presign_upload(image_type, data.get('contentType', 'image/png'))
+            return confirm_upload(image_type, data.get('key', ''))
+        
         if not image_type or not image_base64:
             return {
                 'statusCode': 400,
@@ -61,33 +309,20 @@ def handler(event: dict, context) -> dict:
         
         image_data = base64.b64decode(image_base64)
         
-        # Определяем тип файла
-        content_type = 'image/png'
-        if image_base64.startswith('iVBORw'):
-            content_type = 'image/png'
-        elif image_base64.startswith('/9j/'):
-            content_type = 'image/jpeg'
+        # Определяем формат по содержимому файла
+        if detect_content_type(image_data) is None:
+            return error_response(400, 'Неподдерживаемый формат изображения. Допустимые: PNG, JPEG, WebP, GIF')
         
-        # Генерируем имя файла
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        filename = f'company/{image_type}-{timestamp}.png'
-        
-        # Загружаем в S3
-        s3 = boto3.client('s3',
-            endpoint_url='https://bucket.poehali.dev',
-            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
-        )
-        
-        s3.put_object(
-            Bucket='files',
-            Key=filename,
-            Body=image_data,
-            ContentType=content_type
-        )
+        try:
+            stored = store_image(get_s3_client(), image_type, image_data)
+        except InvalidImageError as e:
+            return error_response(400, str(e))
         
         # Формируем CDN URL
-        cdn_url = f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{filename}"
+        url = cdn_url(stored['key'])
+        saved_bytes = len(image_data) - stored['storedBytes']
+        print(f"[UPLOAD] {stored['key']}: {len(image_data)} -> {stored['storedBytes']} bytes, "
+              f"saved {saved_bytes}, deduplicated={stored['deduplicated']}")
         
         return {
             'statusCode': 200,
@@ -97,8 +332,12 @@ def handler(event: dict, context) -> dict:
             },
             'body': json.dumps({
                 'success': True,
-                'url': cdn_url,
+                'url': url,
                 'type': image_type,
+                'originalBytes': len(image_data),
+                'storedBytes': stored['storedBytes'],
+                'savedBytes': saved_bytes,
+                'deduplicated': stored['deduplicated'],
                 'message': 'Изображение успешно загружено'
             })
         }
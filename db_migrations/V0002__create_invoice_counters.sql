@@ -0,0 +1,6 @@
+-- Счётчики номеров счетов по годам (контейнеры резервируют блоки номеров)
+CREATE TABLE IF NOT EXISTS invoice_counters (
+    year INTEGER PRIMARY KEY,
+    last_value BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,12 @@
+-- Сохранённые счета на оплату (выдаются повторно по номеру)
+CREATE TABLE IF NOT EXISTS invoices (
+    invoice_number VARCHAR(32) PRIMARY KEY,
+    user_id VARCHAR(64) NOT NULL,
+    username VARCHAR(255) NOT NULL,
+    amount DECIMAL(12, 2) NOT NULL,
+    html TEXT NOT NULL,
+    etag VARCHAR(64) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_invoices_user_id ON invoices(user_id);
@@ -0,0 +1,21 @@
+-- Платёжные намерения: ожидаемые криптовалютные переводы для сверки
+CREATE TABLE IF NOT EXISTS payment_intents (
+    transaction_id VARCHAR(32) PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    currency VARCHAR(10) NOT NULL,
+    wallet_address VARCHAR(128) NOT NULL,
+    amount_rub DECIMAL(12, 2) NOT NULL,
+    amount_crypto DECIMAL(24, 8) NOT NULL,
+    exchange_rate DECIMAL(18, 8) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    tx_hash VARCHAR(128),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    matched_at TIMESTAMP
+);
+
+-- Поиск ожидающих намерений по валюте и сумме при сверке
+CREATE INDEX IF NOT EXISTS idx_payment_intents_pending_amount
+    ON payment_intents(currency, amount_crypto) WHERE status = 'pending';
+
+-- Один перевод зачисляется не больше одного раза
+CREATE UNIQUE INDEX IF NOT EXISTS idx_payment_intents_tx_hash ON payment_intents(tx_hash);
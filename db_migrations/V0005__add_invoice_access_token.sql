@@ -0,0 +1,2 @@
+-- Токен доступа к сохранённому счёту: номера последовательны, поэтому одного номера недостаточно
+ALTER TABLE invoices ADD COLUMN IF NOT EXISTS access_token VARCHAR(64);
@@ -0,0 +1,25 @@
+-- Срок действия ожидающего намерения: после него сумма освобождается для новых платежей
+ALTER TABLE payment_intents ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP;
+
+UPDATE payment_intents SET expires_at = created_at + INTERVAL '60 minutes' WHERE expires_at IS NULL;
+
+-- Из уже выданных одинаковых сумм ожидающей остаётся только самая ранняя
+UPDATE payment_intents SET status = 'expired'
+WHERE status = 'pending' AND transaction_id IN (
+    SELECT transaction_id FROM (
+        SELECT transaction_id,
+               ROW_NUMBER() OVER (PARTITION BY currency, amount_crypto ORDER BY created_at) AS position
+        FROM payment_intents
+        WHERE status = 'pending'
+    ) ranked
+    WHERE position > 1
+);
+
+-- Сумма уникальна среди ожидающих намерений, поэтому перевод сопоставляется однозначно
+DROP INDEX IF EXISTS idx_payment_intents_pending_amount;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_payment_intents_pending_amount_unique
+    ON payment_intents(currency, amount_crypto) WHERE status = 'pending';
+
+-- Поиск просроченных ожидающих намерений
+CREATE INDEX IF NOT EXISTS idx_payment_intents_pending_expires
+    ON payment_intents(expires_at) WHERE status = 'pending';
@@ -0,0 +1,4 @@
+-- Внешний идентификатор пополнения (например, crypto:<tx_hash>): повторное зачисление по нему отклоняется
+ALTER TABLE topup_history ADD COLUMN IF NOT EXISTS reference VARCHAR(128);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_topup_history_reference ON topup_history(reference);
@@ -0,0 +1,3 @@
+-- Суммы истёкших намерений в карантине: проверяются при выдаче новой суммы и при сверке
+CREATE INDEX IF NOT EXISTS idx_payment_intents_expired_amount
+    ON payment_intents(currency, amount_crypto, expires_at) WHERE status = 'expired';
@@ -2,6 +2,7 @@ import { useEffect, useState } from 'react';
 import { Card, CardContent, CardDescription, CardHeader, CardTitle } from '@/components/ui/card';
 import Icon from '@/components/ui/icon';
 import { Button } from '@/components/ui/button';
+import { timerFetch } from '@/lib/timerApi';
 
 interface TimerData {
   id: number;
@@ -22,7 +23,7 @@ const TimersOverview = () => {
 
   const fetchTimers = async () => {
     try {
-      const response = await fetch('https://functions.poehali.dev/a23898cb-270c-4d21-8199-e4efe343c233');
+      const response = await timerFetch();
       const data = await response.json();
       setTimers(Array.isArray(data) ? data : []);
       setLastUpdate(new Date());
@@ -35,7 +36,7 @@ const TimersOverview = () => {
 
   const processDeductions = async () => {
     try {
-      await fetch('https://functions.poehali.dev/a23898cb-270c-4d21-8199-e4efe343c233', {
+      await timerFetch('', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ action: 'process_deductions' })
@@ -0,0 +1,34 @@
+export const TIMER_MANAGER_URL = 'https://functions.poehali.dev/a23898cb-270c-4d21-8199-e4efe343c233';
+
+// Позиция WAL последней записи этого браузера: чтения с ней не уйдут на отстающую реплику
+const WRITE_LSN_KEY = 'timerManagerWriteLsn';
+
+const parseLsn = (lsn: string) => {
+  const [high, low] = lsn.split('/');
+  return BigInt(`0x${high}`) * 2n ** 32n + BigInt(`0x${low}`);
+};
+
+const rememberWriteLsn = (lsn: string) => {
+  const previous = localStorage.getItem(WRITE_LSN_KEY);
+  if (!previous || parseLsn(lsn) > parseLsn(previous)) {
+    localStorage.setItem(WRITE_LSN_KEY, lsn);
+  }
+};
+
+// fetch к timer-manager с read-your-writes: отправляет X-Min-Lsn и запоминает X-Write-Lsn ответа
+export const timerFetch = async (query = '', init: RequestInit = {}) => {
+  const headers = new Headers(init.headers);
+  const minLsn = localStorage.getItem(WRITE_LSN_KEY);
+  if (minLsn) {
+    headers.set('X-Min-Lsn', minLsn);
+  }
+
+  const response = await fetch(`${TIMER_MANAGER_URL}${query}`, { ...init, headers });
+
+  const writeLsn = response.headers.get('X-Write-Lsn');
+  if (writeLsn) {
+    rememberWriteLsn(writeLsn);
+  }
+
+  return response;
+};
@@ -8,6 +8,7 @@ import { useToast } from '@/hooks/use-toast';
 import Icon from '@/components/ui/icon';
 import { Tabs, TabsContent, TabsList, TabsTrigger } from '@/components/ui/tabs';
 import TimersOverview from '@/components/admin/TimersOverview';
+import { timerFetch } from '@/lib/timerApi';
 
 const Admin = () => {
   const navigate = useNavigate();
@@ -44,7 +45,7 @@ const Admin = () => {
   const loadTopupHistory = async () => {
     try {
       console.log('[LOAD_TOPUP_HISTORY] Requesting history...');
-      const response = await fetch('https://functions.poehali.dev/a23898cb-270c-4d21-8199-e4efe343c233', {
+      const response = await timerFetch('', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ action: 'get_topup_history' })
@@ -92,7 +93,7 @@ const Admin = () => {
     const balance = totalMinutes * (coefficients[userId] || 1);
 
     try {
-      const response = await fetch('https://functions.poehali.dev/a23898cb-270c-4d21-8199-e4efe343c233', {
+      const response = await timerFetch('', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -154,7 +155,7 @@ const Admin = () => {
     }
 
     try {
-      const response = await fetch('https://functions.poehali.dev/a23898cb-270c-4d21-8199-e4efe343c233', {
+      const response = await timerFetch('', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
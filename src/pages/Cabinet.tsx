@@ -6,6 +6,7 @@ import Icon from '@/components/ui/icon';
 import BalanceCard from '@/components/cabinet/BalanceCard';
 import PaymentSection from '@/components/cabinet/PaymentSection';
 import NotificationsCard from '@/components/cabinet/NotificationsCard';
+import { timerFetch } from '@/lib/timerApi';
 
 interface TopupHistoryEntry {
   date: string;
@@ -37,7 +38,7 @@ const Cabinet = () => {
 
     const fetchUserData = async () => {
       try {
-        const response = await fetch(`https://functions.poehali.dev/a23898cb-270c-4d21-8199-e4efe343c233?user_id=${id}`);
+        const response = await timerFetch(`?user_id=${id}`);
         const data = await response.json();
         
         if (data.balance !== null && data.balance !== undefined) {
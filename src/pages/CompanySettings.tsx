@@ -5,12 +5,48 @@ import { Button } from '@/components/ui/button';
 import { Label } from '@/components/ui/label';
 import Icon from '@/components/ui/icon';
 
+const UPLOAD_IMAGES_URL = 'https://functions.poehali.dev/8b75370e-8a14-4f88-a342-2e1a9f27917c';
+
+// Эти форматы загружаются напрямую в хранилище по подписанной форме, остальные - через base64
+const DIRECT_UPLOAD_TYPES = ['image/png', 'image/jpeg', 'image/webp'];
+
+const postJson = async (body: object) => {
+  const response = await fetch(UPLOAD_IMAGES_URL, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify(body)
+  });
+  return response.json();
+};
+
+const uploadDirect = async (file: File, type: 'signature' | 'stamp') => {
+  const presign = await postJson({ action: 'presign', type, contentType: file.type });
+  if (!presign.success) {
+    return presign;
+  }
+
+  const form = new FormData();
+  Object.entries(presign.fields as Record<string, string>).forEach(([name, value]) => form.append(name, value));
+  form.append('file', file);
+
+  const uploadResponse = await fetch(presign.uploadUrl, { method: 'POST', body: form });
+  if (!uploadResponse.ok) {
+    return { success: false, error: `хранилище отклонило файл (${uploadResponse.status})` };
+  }
+
+  return postJson({ action: 'confirm', type, key: presign.key });
+};
+
 const CompanySettings = () => {
   const navigate = useNavigate();
   const [signaturePreview, setSignaturePreview] = useState<string>('');
   const [stampPreview, setStampPreview] = useState<string>('');
   const [signatureUrl, setSignatureUrl] = useState<string>('');
   const [stampUrl, setStampUrl] = useState<string>('');
+  const [files, setFiles] = useState<{ signature: File | null; stamp: File | null }>({
+    signature: null,
+    stamp: null
+  });
   const [loading, setLoading] = useState<{ signature: boolean; stamp: boolean }>({
     signature: false,
     stamp: false
@@ -33,6 +69,8 @@ const CompanySettings = () => {
       return;
     }
 
+    setFiles(prev => ({ ...prev, [type]: file }));
+
     const reader = new FileReader();
     reader.onloadend = () => {
       const base64 = reader.result as string;
@@ -56,16 +94,10 @@ const CompanySettings = () => {
     setLoading(prev => ({ ...prev, [type]: true }));
 
     try {
-      const response = await fetch('https://functions.poehali.dev/8b75370e-8a14-4f88-a342-2e1a9f27917c', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-          type,
-          image: preview
-        })
-      });
-
-      const data = await response.json();
+      const file = files[type];
+      const data = file && DIRECT_UPLOAD_TYPES.includes(file.type)
+        ? await uploadDirect(file, type)
+        : await postJson({ type, image: preview });
       
       if (data.success) {
         if (type === 'signature') {
@@ -94,11 +126,13 @@ const CompanySettings = () => {
     if (type === 'signature') {
       setSignaturePreview('');
       setSignatureUrl('');
+      setFiles(prev => ({ ...prev, signature: null }));
       const input = document.getElementById('signature') as HTMLInputElement;
       if (input) input.value = '';
     } else {
       setStampPreview('');
       setStampUrl('');
+      setFiles(prev => ({ ...prev, stamp: null }));
       const input = document.getElementById('stamp') as HTMLInputElement;
       if (input) input.value = '';
     }